@@ -3,9 +3,28 @@ import pygame_gui
 from events import *
 
 class Panel:
+    """The side panel. It is only updated and drawn when something on it changed.
+
+    Labels are only re-rendered when their text changes, and the panel area of the screen is
+    only redrawn when it is `dirty`, or while the mouse is on it. The renderer leaves that area
+    of the screen alone otherwise, so the last drawing stays on screen.
+    """
+
+    # Phases shown in the timing breakdown, with their labels. 'frame' is timed on the render
+    # thread, the others on the physics thread.
+    TIMED_PHASES = (('physics', 'Step'), ('space.step', 'Space'), ('waves', 'Waves'),
+                    ('viewport', 'Cull'), ('frame', 'Frame'))
+    SPARKLINE_SCALE = 2 / 60  # Seconds at the top of the sparkline.
+    SPARKLINE_INTERVAL = 0.25  # Seconds between redraws of the sparkline.
+    ACTIVE_TIME = 0.5  # Seconds the panel keeps updating after the mouse left it, for hover effects.
+
     def __init__(self, screen_width, screen_height, game_scene):
         self.width = 150
         self.game_scene = game_scene
+        self.rect = pygame.Rect((screen_width - self.width, 0), (self.width, screen_height))
+        self.dirty = True
+        self.active = 0.0
+        self.sparkline_age = 0.0
 
         self.manager = pygame_gui.UIManager((screen_width, screen_height), "GUI/theme.json")
 
@@ -59,29 +78,170 @@ class Panel:
             parent_element=self.panel
         )
 
+        # Rolling p50/p95 of the hot phases, in milliseconds.
+        self.timing_labels = {}
+        for row, (name, title) in enumerate(self.TIMED_PHASES):
+            self.timing_labels[name] = pygame_gui.elements.UILabel(
+                relative_rect=pygame.Rect((5, 180 + 25 * row), (140, 25)),
+                text=f'{title}: -',
+                manager=self.manager,
+                container=self.container,
+                parent_element=self.panel
+            )
+
+        # Recent physics step (green) and frame (white) times, drawn over the panel.
+        self.sparkline_rect = pygame.Rect((screen_width - self.width + 5, 185 + 25 * len(self.TIMED_PHASES)),
+                                          (140, 60))
+
+        # Energy statistics, measured once per slow update.
+        energy_top = self.sparkline_rect.bottom + 5
+        self.kinetic_energy_label = pygame_gui.elements.UILabel(
+            relative_rect=pygame.Rect((5, energy_top), (140, 25)),
+            text='KE: -',
+            manager=self.manager,
+            container=self.container,
+            parent_element=self.panel
+        )
+        self.temperature_label = pygame_gui.elements.UILabel(
+            relative_rect=pygame.Rect((5, energy_top + 25), (140, 25)),
+            text='Temp: -',
+            manager=self.manager,
+            container=self.container,
+            parent_element=self.panel
+        )
+        self.momentum_label = pygame_gui.elements.UILabel(
+            relative_rect=pygame.Rect((5, energy_top + 50), (140, 25)),
+            text='|p|: -',
+            manager=self.manager,
+            container=self.container,
+            parent_element=self.panel
+        )
+        # Speed histogram, drawn over the panel like the sparkline.
+        self.histogram_rect = pygame.Rect((screen_width - self.width + 5, energy_top + 80), (140, 40))
+        self.speed_histogram = None
+
+        # Engine state, below the histogram.
+        engine_top = self.histogram_rect.bottom + 5
+        self.frozen_label = pygame_gui.elements.UILabel(
+            relative_rect=pygame.Rect((5, engine_top), (140, 25)),
+            text='Frozen: -',
+            manager=self.manager,
+            container=self.container,
+            parent_element=self.panel
+        )
+        self.broadphase_label = pygame_gui.elements.UILabel(
+            relative_rect=pygame.Rect((5, engine_top + 25), (140, 25)),
+            text='Hash: -',
+            manager=self.manager,
+            container=self.container,
+            parent_element=self.panel
+        )
+
     def process_events(self, event):
-        # Make sure we don't process the custom events.
-        self.manager.process_events(event)
+        # Anything the UI reacts to, or that happens over the panel, keeps it updating a while.
+        consumed = self.manager.process_events(event)
+        position = getattr(event, 'pos', None)
+        if consumed or (position is not None and self.rect.collidepoint(position)):
+            self.active = self.ACTIVE_TIME
 
         if event.type == pygame_gui.UI_HORIZONTAL_SLIDER_MOVED:
             if event.ui_element == self.speed_slider:
-                self.game_scene.game_speed = event.value
-
+                self.game_scene.request_speed(event.value)
 
     def update(self, delta_time):
-        self.manager.update(delta_time)
+        if self.rect.collidepoint(pygame.mouse.get_pos()):
+            self.active = self.ACTIVE_TIME
+        else:
+            self.active = max(0.0, self.active - delta_time)
+        self.sparkline_age += delta_time
+        if self.sparkline_age >= self.SPARKLINE_INTERVAL:
+            self.dirty = True
+        if self.dirty or self.active:
+            self.manager.update(delta_time)
 
     def render(self, screen):
+        if not (self.dirty or self.active):
+            return
         self.manager.draw_ui(screen)
+        self.render_sparkline(screen)
+        self.render_histogram(screen)
+        self.dirty = False
+        self.sparkline_age = 0.0
+
+    def set_label(self, label, text):
+        # pygame_gui would skip an unchanged text too, but the panel would still be redrawn.
+        if text != label.text:
+            label.set_text(text)
+            self.dirty = True
+
+    def render_sparkline(self, screen):
+        rect = self.sparkline_rect
+        pygame.draw.rect(screen, (21, 26, 38), rect)
+        # The 60 Hz budget.
+        budget_y = rect.bottom - rect.height / (60 * self.SPARKLINE_SCALE)
+        pygame.draw.line(screen, (87, 96, 124), (rect.left, budget_y), (rect.right - 1, budget_y))
+
+        for timer, name, color in ((self.game_scene.timer, 'physics', (22, 160, 133)),
+                                   (self.game_scene.render_timer, 'frame', (218, 223, 226))):
+            samples = timer.recent(name)[-rect.width:]
+            if len(samples) < 2:
+                continue
+            points = [(rect.left + x, rect.bottom - 1 - min(seconds / self.SPARKLINE_SCALE, 1) * (rect.height - 1))
+                      for x, seconds in enumerate(samples)]
+            pygame.draw.lines(screen, color, False, points)
 
     def set_fps_psu(self, fps, psu):
-        self.fps_psu_label.set_text(f"FPS: {fps} | PSU: {psu}")
+        self.set_label(self.fps_psu_label, f"FPS: {fps} | PSU: {psu}")
+
+    def set_speed_slider(self, speed):
+        self.speed_slider.set_current_value(speed)
+        self.dirty = True
 
     def set_game_speed(self, speed):
-        self.game_speed_label.set_text(f"SPEED: {speed}x")
+        self.set_label(self.game_speed_label, f"SPEED: {speed}x")
 
     def set_molecules_count(self, count):
-        self.molecules_count_label.set_text(f"Molecules: {count}")
+        self.set_label(self.molecules_count_label, f"Molecules: {count}")
 
     def set_waves_count(self, count):
-        self.waves_count_label.set_text(f"Waves: {count}")
+        self.set_label(self.waves_count_label, f"Waves: {count}")
+
+    def render_histogram(self, screen):
+        rect = self.histogram_rect
+        pygame.draw.rect(screen, (21, 26, 38), rect)
+        if self.speed_histogram is None or self.speed_histogram.max() == 0:
+            return
+        bar_width = rect.width / len(self.speed_histogram)
+        scale = (rect.height - 1) / self.speed_histogram.max()
+        for i, count in enumerate(self.speed_histogram.tolist()):
+            height = max(1, round(count * scale)) if count else 0
+            pygame.draw.rect(screen, (22, 160, 133),
+                             (rect.left + round(i * bar_width), rect.bottom - height, max(1, int(bar_width) - 1), height))
+
+    def set_energy(self, energy):
+        self.set_label(self.kinetic_energy_label, f"KE: {energy['kinetic_energy']:.3g}")
+        self.set_label(self.temperature_label, f"Temp: {energy['mean_energy']:.3g}")
+        momentum = (energy['momentum'][0] ** 2 + energy['momentum'][1] ** 2) ** 0.5
+        self.set_label(self.momentum_label, f"|p|: {momentum:.3g}")
+        self.speed_histogram = energy['speed_histogram']
+        self.dirty = True
+
+    def set_frozen(self, regions, molecules):
+        self.set_label(self.frozen_label, f"Frozen: {regions} | {molecules}")
+
+    def set_broadphase(self, tuning, results):
+        # The spatial hash the BroadphaseTuner picked, with its median space.step time.
+        if tuning:
+            text = "Hash: tuning"
+        elif results:
+            (dim, count), seconds = min(results.items(), key=lambda item: item[1])
+            text = f"Hash: {dim:.3g}/{count // 1000}k {seconds * 1000:.1f}ms"
+        else:
+            text = "Hash: -"
+        self.set_label(self.broadphase_label, text)
+
+    def set_timings(self, report):
+        for name, title in self.TIMED_PHASES:
+            phase = report.get(name)
+            if phase is not None and 'p50' in phase:
+                self.set_label(self.timing_labels[name], f"{title}: {phase['p50'] * 1000:.1f}/{phase['p95'] * 1000:.1f}ms")
@@ -0,0 +1,181 @@
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+import numpy as np
+
+from particles.molecule_store import MoleculeStore
+from scenes.headless import HeadlessRunner
+from scenes.partitioned import ID, MASS, RADIUS, RECORD_SIZE, VX, VY, X, Y, PartitionedSimulation, make_space
+
+
+def peak_rss_mb(who=None):
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_case(molecules_count, steps, seed, warmup):
+    # With the viewport culling a renderer needs, so that its phase is measured too.
+    runner = HeadlessRunner(molecules_count=molecules_count, seed=seed, render=True)
+    warmup_steps = runner.warm_up(warmup)
+    result = runner.run(steps)
+    result['requested'] = molecules_count
+    result['warmup_steps'] = warmup_steps
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def run_partitioned_case(molecules_count, steps, seed, warmup, tiles, gather_interval, dt=1 / 60):
+    with PartitionedSimulation(tiles=tiles) as simulation:
+        start = time.perf_counter()
+        simulation.populate(molecules_count, seed)
+        init_time = time.perf_counter() - start
+        for _ in range(warmup):
+            simulation.step(dt)
+        simulation.timer.reset()
+        start = time.perf_counter()
+        for step in range(1, steps + 1):
+            simulation.step(dt)
+            if gather_interval and step % gather_interval == 0:
+                simulation.gather()
+        elapsed = time.perf_counter() - start
+
+    return {
+        'requested': molecules_count,
+        'molecules': simulation.molecules_count,
+        'steps': steps,
+        'elapsed': elapsed,
+        'steps_per_sec': steps / elapsed if elapsed > 0 else 0.0,
+        'init_time': init_time,
+        'phases': simulation.timer.report(),
+        'peak_rss_mb': peak_rss_mb(),
+        # The largest tile worker, they are all joined by now.
+        'worker_peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+    }
+
+
+def check_tile_collision(steps=60, dt=1 / 60):
+    """Collide a heavy and a light molecule across the edge of a 2x1 tiling and compare with one space.
+
+    Both tiles resolve the collision against a ghost of the other molecule, so the velocities and
+    the total momentum after it must match the single-space run.
+    """
+    records = np.zeros((2, RECORD_SIZE))
+    records[:, ID] = (0, 1)
+    records[:, X], records[:, Y] = (490, 510), 500
+    records[:, VX] = (60, -60)
+    records[:, MASS], records[:, RADIUS] = (10, 1), 5
+
+    with PartitionedSimulation(world_width=1000, world_height=1000, tiles=(2, 1)) as simulation:
+        simulation.start(records)
+        for _ in range(steps):
+            simulation.step(dt)
+        tiled = simulation.records()
+    tiled = tiled[np.argsort(tiled[:, ID])]
+
+    space = make_space(simulation.space_settings(len(records)), 1000, 1000)
+    bodies = []
+    for record in records:
+        body, shape = MoleculeStore.create_body(record[RADIUS], record[MASS], (record[X], record[Y]))
+        body.velocity = (record[VX], record[VY])
+        space.add(body, shape)
+        bodies.append(body)
+    for _ in range(steps):
+        space.step(dt)
+    single = np.array([body.velocity.x for body in bodies])
+
+    result = {
+        'tiled_velocities': tiled[:, VX].tolist(),
+        'single_velocities': single.tolist(),
+        'tiled_momentum': float(tiled[:, MASS] @ tiled[:, VX]),
+        'single_momentum': float(records[:, MASS] @ single),
+    }
+    result['ok'] = bool(np.allclose(tiled[:, VX], single, atol=0.5))
+    return result
+
+
+def isolated(connection, function, args):
+    connection.send(function(*args))
+    connection.close()
+
+
+def run_isolated(function, *args):
+    # A plain (non-daemonic) process, so that partitioned runs can start their own workers.
+    context = multiprocessing.get_context('spawn')
+    parent, child = context.Pipe(duplex=False)
+    process = context.Process(target=isolated, args=(child, function, args))
+    process.start()
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        raise RuntimeError(f"Benchmark case {function.__name__}{args} crashed") from None
+    process.join()
+    return result
+
+
+def print_result(result):
+    rss = result['peak_rss_mb']
+    print(f"{result['requested']:>8} requested | {result['molecules']:>8} molecules | "
+          f"init {result['init_time']:.2f}s | {result['steps_per_sec']:.1f} steps/s | "
+          f"peak RSS {'n/a' if rss is None else f'{rss:.0f} MB'}")
+    if result.get('worker_peak_rss_mb') is not None:
+        print(f"    largest tile worker peak RSS {result['worker_peak_rss_mb']:.0f} MB")
+    if result.get('warmup_steps') is not None:
+        print(f"    warmup {result['warmup_steps']} steps, until the spatial hash was tuned")
+    for name, phase in result.get('startup', {}).items():
+        print(f"    startup {name:<18} {phase['total']:8.3f}s")
+    for name, phase in result['phases'].items():
+        share = phase['total'] / result['elapsed'] * 100 if result['elapsed'] else 0
+        print(f"    {name:<12} {phase['mean'] * 1000:9.3f} ms/call p95 {phase['p95'] * 1000:9.3f} ms "
+              f"{phase['total']:8.3f}s {share:5.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless GameScene benchmark.")
+    parser.add_argument('--counts', type=int, nargs='+', default=[10000, 40000, 100000])
+    parser.add_argument('--steps', type=int, default=300)
+    parser.add_argument('--warmup', type=int, default=10,
+                        help="Steps before measuring, more if the spatial hash is still being tuned.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help="Print one JSON object per case.")
+    parser.add_argument('--tiles', type=int, nargs=2, metavar=('X', 'Y'),
+                        help="Benchmark the multi-process PartitionedSimulation with X by Y tiles.")
+    parser.add_argument('--check-tiles', action='store_true',
+                        help="Check that a collision across a tile edge conserves momentum, then exit.")
+    parser.add_argument('--gather-interval', type=int, default=30,
+                        help="Partitioned runs: read all positions back every n steps, 1 as a renderer would, "
+                             "0 for never.")
+    args = parser.parse_args()
+
+    if args.check_tiles:
+        result = check_tile_collision()
+        print(f"tiled  velocities {result['tiled_velocities']} momentum {result['tiled_momentum']:.1f}")
+        print(f"single velocities {result['single_velocities']} momentum {result['single_momentum']:.1f}")
+        sys.exit(0 if result['ok'] else 1)
+
+    # Each case runs in a fresh process so that peak RSS is measured per molecule count.
+    for count in args.counts:
+        if args.tiles:
+            result = run_isolated(run_partitioned_case, count, args.steps, args.seed, args.warmup, tuple(args.tiles),
+                                  args.gather_interval)
+        else:
+            result = run_isolated(run_case, count, args.steps, args.seed, args.warmup)
+        if args.json:
+            print(json.dumps(result), flush=True)
+        else:
+            print_result(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,3 +2,23 @@ import pygame
 
 SLOW_UPDATE_EVENT = pygame.event.custom_type()
 WAVE_INIT_EVENT = pygame.event.custom_type()
+
+
+class EventBus:
+    """Drains the pygame event queue once per frame and fans every event out to its subscribers.
+
+    A subscriber gets the events of the types it subscribed to, or all events if it gave none.
+    Every event goes to its subscribers in the order they subscribed.
+    """
+
+    def __init__(self):
+        self.subscribers = []  # (set of event types or None, handler)
+
+    def subscribe(self, handler, *event_types):
+        self.subscribers.append((set(event_types) or None, handler))
+
+    def dispatch(self):
+        for event in pygame.event.get():
+            for event_types, handler in self.subscribers:
+                if event_types is None or event.type in event_types:
+                    handler(event)
@@ -1,21 +1,34 @@
+import argparse
 import time
 
 import pygame
 import threading
 import cProfile
 from events import *
+from particles.field import ForceField
+from scenes.capture import FrameCapture
 from scenes.game_scene import GameScene
+from scenes.metrics import MetricsExporter
+from scenes.replay import Recorder
 
 
 class Main:
-    def __init__(self):
+    def __init__(self, checkpoint_path=None, seed=None, record_path=None, capture_args=None, field=None):
         pygame.init()
         self.clock = pygame.time.Clock()
-        self.scene = GameScene()
+        self.scene = GameScene(seed=seed, checkpoint_path=checkpoint_path, field=field)
+        if record_path is not None:
+            self.scene.recorder = Recorder(record_path, self.scene)
+        if capture_args is not None:
+            self.scene.capture = open_capture(capture_args, self.scene)
         self.physics_thread = threading.Thread(target=self.physics_loop)
         self.running = False
-        self.physics_updates = 0
-        self.last_time = time.time()
+
+        # The only consumer of the pygame event queue.
+        self.events = EventBus()
+        self.events.subscribe(self.quit, pygame.QUIT)
+        self.events.subscribe(self.slow_update, SLOW_UPDATE_EVENT)
+        self.scene.subscribe(self.events)
 
         pygame.time.set_timer(SLOW_UPDATE_EVENT, 1000)
 
@@ -26,47 +39,120 @@ class Main:
     def stop(self):
         self.running = False
         self.physics_thread.join()
+        if self.scene.recorder is not None:
+            self.scene.recorder.close(self.scene)
+        if self.scene.capture is not None:
+            self.scene.capture.close()
+            print_capture(self.scene.capture)
+
+    def quit(self, event):
+        self.running = False
+
+    def slow_update(self, event):
+        self.scene.update_slow()
 
     def physics_loop(self):
-        t1 = time.time()
+        stepper = self.scene.stepper
+        t1 = time.perf_counter()
         while self.running:
-            t2 = time.time()
-            dt = t2 - t1
-            self.scene.update_physics(dt)
-            self.physics_updates += 1
+            t2 = time.perf_counter()
+            stepper.advance(t2 - t1)
             t1 = t2
-            if t2 - self.last_time > 1:
-                self.last_time = t2
-                self.scene.psu = self.physics_updates
-                self.physics_updates = 0
+
+            # Don't burn a core when the simulation is ahead, sleep(0) still yields to the render thread.
+            time.sleep(stepper.time_until_next_step())
 
     def main_loop(self):
         self.start()
         while self.running:
             dt = self.clock.tick(60) / 1000.0
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.running = False
-                elif event.type == SLOW_UPDATE_EVENT:
-                    self.scene.update_slow()
-                self.scene.process_events(event)
-
-            # Update the scene with details.
-            self.scene.fps = self.clock.get_fps()
-            self.scene.handle_input()
+            # The work of a frame, without the wait in tick().
+            with self.scene.render_timer.phase('frame'):
+                self.events.dispatch()
 
-            # Update the scene.
-            self.scene.update(dt)
+                # Update the scene with details.
+                self.scene.fps = self.clock.get_fps()
+                self.scene.handle_input()
 
-            # Render everything.
-            self.scene.render()
+                # Update the scene.
+                self.scene.update(dt)
 
-            pygame.display.flip()
+                # Render everything, the renderer flips the display.
+                self.scene.render()
 
         self.stop()
         pygame.quit()
 
 
+def open_capture(args, scene):
+    # Headless runs have no frame rate to keep, they wait for the writer instead of dropping frames.
+    return FrameCapture(args.capture or '', (scene.screen_width, scene.screen_height), command=args.capture_command,
+                        pool_size=args.capture_pool, interval=args.capture_interval, drop=not scene.headless)
+
+
+def print_capture(capture):
+    report = capture.report()
+    print(f"captured {report['captured']} frames of {report['size'][0]}x{report['size'][1]}, "
+          f"{report['written']} written, {report['dropped']} dropped" +
+          (f", stopped: {report['error']}" if report['error'] else ""))
+
+
 if __name__ == "__main__":
-    Main().main_loop()
+    parser = argparse.ArgumentParser(description="HyperLife sandbox.")
+    parser.add_argument('--headless', action='store_true', help="Run the simulation without a window.")
+    parser.add_argument('--steps', type=int, default=1000, help="Number of fixed steps in headless mode.")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--molecules', type=int, default=40000)
+    parser.add_argument('--checkpoint', help="Resume from this checkpoint file (F5 saves quicksave.hlc).")
+    parser.add_argument('--save', help="Headless mode: write a checkpoint here when done.")
+    parser.add_argument('--record', help="Stream the run's inputs and periodic keyframes to this replay log.")
+    parser.add_argument('--replay', help="Re-run a replay log headless, as fast as possible.")
+    parser.add_argument('--metrics', help="Headless mode: export phase timings to this .csv or .jsonl file.")
+    parser.add_argument('--field', choices=ForceField.KINDS, help="Add a long-range force field.")
+    parser.add_argument('--capture', help="Record the frames: a .png pattern for an image sequence, "
+                                          "any other path for raw RGB24 frames.")
+    parser.add_argument('--capture-command', help="Pipe the raw frames to this encoder command instead, "
+                                                  "{width} and {height} are filled in.")
+    parser.add_argument('--capture-pool', type=int, default=8, help="Frames buffered before frames are dropped.")
+    parser.add_argument('--capture-interval', type=int, default=1, help="Capture every n-th frame.")
+    args = parser.parse_args()
+
+    if args.replay:
+        from scenes.replay import Replayer
+        result = Replayer(args.replay).run()
+        print(f"{result['molecules']} molecules, {result['steps']} steps, {result['steps_per_sec']:.1f} steps/s")
+        for step, drift in result['drift'].items():
+            print(f"keyframe {step}: " + ("missing" if drift is None else f"max position drift {drift:.6g}"))
+    elif args.headless:
+        from scenes.headless import HeadlessRunner
+        runner = HeadlessRunner(molecules_count=args.molecules, seed=args.seed, checkpoint_path=args.checkpoint,
+                                field=args.field)
+        capture = None
+        if args.capture or args.capture_command:
+            capture = open_capture(args, runner.scene)
+            runner.start_capture(capture)
+        if args.record:
+            runner.scene.recorder = Recorder(args.record, runner.scene)
+        exporter = MetricsExporter(args.metrics) if args.metrics else None
+        result = runner.run(args.steps, exporter)
+        if exporter is not None:
+            exporter.close()
+        if args.record:
+            runner.scene.recorder.close(runner.scene)
+        if capture is not None:
+            capture.close()
+        print(f"{result['molecules']} molecules, {result['steps']} steps, {result['steps_per_sec']:.1f} steps/s")
+        startup = ', '.join(f"{name} {phase['total']:.2f}s" for name, phase in result['startup'].items())
+        print(f"startup {result['init_time']:.2f}s: {startup}")
+        energy = result['energy']
+        print(f"kinetic energy {energy['kinetic_energy']:.4g}, mean energy {energy['mean_energy']:.4g}, "
+              f"momentum ({energy['momentum'][0]:.4g}, {energy['momentum'][1]:.4g}), max speed {energy['max_speed']:.4g}")
+        if capture is not None:
+            print_capture(capture)
+        if args.save:
+            runner.scene.save_checkpoint(args.save)
+    else:
+        capture_args = args if args.capture or args.capture_command else None
+        Main(checkpoint_path=args.checkpoint, seed=args.seed, record_path=args.record,
+             capture_args=capture_args, field=args.field).main_loop()
     # cProfile.run('Main().main_loop()',  sort='tottime')
@@ -0,0 +1,100 @@
+# particles/field.py
+import numpy as np
+
+
+class ForceField:
+    """Long-range forces between all molecules through a coarse grid (particle-mesh), O(N) per pass.
+
+    Every `interval` steps the molecule masses are deposited onto a grid of `cell_size` cells
+    with cloud-in-cell weights, the grid is convolved with the kernel of the field by FFT, and
+    the gradient of the resulting potential is interpolated back to the molecules with the same
+    weights. The velocity change for the `interval` steps is queued as one batch of impulses;
+    molecules whose change is below `min_kick` are left out, which spares the pymunk writes.
+
+    The grid is zero-padded to twice its size, so the FFT convolution does not wrap around the
+    (walled, non-periodic) world. Kinds:
+
+    - 'gravity': potential -strength * m / sqrt(d^2 + softening^2), molecules attract each
+      other and clump together.
+    - 'pressure': the density blurred with a Gaussian of width `softening`, times strength;
+      molecules are pushed out of dense areas, a negative strength pulls them in instead.
+
+    Frozen molecules (see scenes.regions) add their mass but are not pushed, an impulse would
+    wake them up.
+    """
+
+    KINDS = ('gravity', 'pressure')
+    STRENGTHS = {'gravity': 100.0, 'pressure': 50000.0}
+
+    def __init__(self, world_width, world_height, kind='gravity', strength=None, cell_size=50, softening=100,
+                 interval=20, min_kick=0.01):
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown field kind {kind!r}, expected one of {self.KINDS}")
+        self.kind = kind
+        self.strength = self.STRENGTHS[kind] if strength is None else strength
+        self.cell_size = cell_size
+        self.softening = softening
+        self.interval = interval
+        self.min_kick = min_kick
+        self.columns = int(world_width // cell_size) + 1
+        self.rows = int(world_height // cell_size) + 1
+        self.kernel = self.kernel_spectrum()
+        self.steps = 0
+        self.potential = np.zeros((self.rows, self.columns))
+
+    def kernel_spectrum(self):
+        # Distances on the padded grid, measured both ways round so the kernel is symmetric.
+        rows, columns = 2 * self.rows, 2 * self.columns
+        dy = np.minimum(np.arange(rows), rows - np.arange(rows)) * self.cell_size
+        dx = np.minimum(np.arange(columns), columns - np.arange(columns)) * self.cell_size
+        squared = dy[:, None] ** 2 + dx[None, :] ** 2
+        if self.kind == 'gravity':
+            kernel = -self.strength / np.sqrt(squared + self.softening ** 2)
+        else:
+            # Per unit area, so the potential is strength times the smoothed density.
+            sigma = self.softening
+            kernel = self.strength * np.exp(-squared / (2 * sigma ** 2)) / (2 * np.pi * sigma ** 2)
+        return np.fft.rfft2(kernel)
+
+    def step(self):
+        """Count a physics step; True when a pass is due."""
+        self.steps += 1
+        return self.steps % self.interval == 0
+
+    def weights(self, positions):
+        """Cloud-in-cell corners: flat cell ids (n, 4) and their weights (n, 4)."""
+        x = np.clip(positions[:, 0] / self.cell_size - 0.5, 0, self.columns - 1)
+        y = np.clip(positions[:, 1] / self.cell_size - 0.5, 0, self.rows - 1)
+        column = np.minimum(x.astype(np.intp), self.columns - 2)
+        row = np.minimum(y.astype(np.intp), self.rows - 2)
+        fx, fy = x - column, y - row
+        base = row * self.columns + column
+        cells = np.stack([base, base + 1, base + self.columns, base + self.columns + 1], axis=1)
+        weights = np.stack([(1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy], axis=1)
+        return cells, weights
+
+    def accelerations(self, positions, masses):
+        """The field's acceleration at every position, as an (n, 2) array."""
+        cells, weights = self.weights(positions)
+        mass = np.bincount(cells.ravel(), (weights * masses[:, None]).ravel(), minlength=self.rows * self.columns)
+        padded = np.zeros((2 * self.rows, 2 * self.columns))
+        padded[:self.rows, :self.columns] = mass.reshape(self.rows, self.columns)
+        potential = np.fft.irfft2(np.fft.rfft2(padded) * self.kernel, s=padded.shape)
+        self.potential = potential[:self.rows, :self.columns]
+
+        gradient_y, gradient_x = np.gradient(self.potential, self.cell_size)
+        acceleration_x = -(gradient_x.ravel()[cells] * weights).sum(axis=1)
+        acceleration_y = -(gradient_y.ravel()[cells] * weights).sum(axis=1)
+        return np.stack([acceleration_x, acceleration_y], axis=1)
+
+    def apply(self, molecules, dt):
+        """Queue the impulses of the field for the last `interval` steps of length dt."""
+        ids = molecules.indices()
+        if len(ids) == 0:
+            return 0
+        masses = molecules.masses[ids].astype(np.float64)
+        accelerations = self.accelerations(molecules.read_positions(ids), masses)
+        kicks = accelerations * (dt * self.interval)
+        pushed = ~molecules.frozen[ids] & (np.hypot(kicks[:, 0], kicks[:, 1]) >= self.min_kick)
+        molecules.queue_impulses(ids[pushed], kicks[pushed] * masses[pushed, None])
+        return int(pushed.sum())
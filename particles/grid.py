@@ -0,0 +1,31 @@
+# particles/grid.py
+import numpy as np
+
+
+class Grid:
+    """Square cells of `cell_size` over the world, numbered row by row.
+
+    The last column and row reach past the world edge, and positions outside the world fall in
+    the nearest edge cell.
+    """
+
+    def __init__(self, world_width, world_height, cell_size):
+        self.cell_size = cell_size
+        self.columns = int(world_width // cell_size) + 1
+        self.rows = int(world_height // cell_size) + 1
+
+    def __len__(self):
+        return self.columns * self.rows
+
+    def cells_in(self, left, top, right, bottom):
+        """Ids of the cells overlapping a world rectangle, edges included."""
+        cell = self.cell_size
+        columns = np.arange(max(0, int(left // cell)), min(self.columns - 1, int(right // cell)) + 1)
+        rows = np.arange(max(0, int(top // cell)), min(self.rows - 1, int(bottom // cell)) + 1)
+        return (rows[:, None] * self.columns + columns[None, :]).ravel()
+
+    def cell_of(self, positions):
+        """Cell ids of an (n, 2) array of positions."""
+        column = np.clip((positions[:, 0] // self.cell_size).astype(np.intp), 0, self.columns - 1)
+        row = np.clip((positions[:, 1] // self.cell_size).astype(np.intp), 0, self.rows - 1)
+        return row * self.columns + column
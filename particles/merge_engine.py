@@ -0,0 +1,133 @@
+# particles/merge_engine.py
+import numpy as np
+
+
+class MergeEngine:
+    """Merges slow, touching molecules of similar density into one.
+
+    Every `interval` steps the velocities of all molecules are read, and only the ones slower
+    than `slow_speed` (which includes every sleeping body) take part. Their positions go into a
+    uniform grid with cells as wide as the largest contact distance, so that every candidate
+    pair is found by looking at the 3x3 neighbouring cells, for all molecules at once.
+
+    A molecule merges at most once per pass, with its nearest partner, and only when it is the
+    nearest partner of that molecule too. All merged molecules are then removed and the results
+    added in one batch each. A result keeps the total mass, the total momentum (so its velocity
+    is the mass-weighted mean), the mass-weighted centre and the total area.
+    """
+
+    def __init__(self, molecules, waves, interval=120, slow_speed=10.0, contact_gap=1.0,
+                 density_tolerance=0.5, max_radius=12.0):
+        self.molecules = molecules
+        self.waves = waves
+        self.interval = interval
+        self.slow_speed = slow_speed
+        self.contact_gap = contact_gap
+        self.density_tolerance = density_tolerance
+        self.max_radius = max_radius
+        self.steps = 0
+        self.merged = 0  # Molecules removed by merging so far.
+
+    def step(self):
+        """Count a physics step; True when a merge pass is due."""
+        self.steps += 1
+        return self.steps % self.interval == 0
+
+    def merge(self):
+        """Run a merge pass. Returns the ids of the removed and of the added molecules, or None if nothing merged."""
+        molecules = self.molecules
+        ids = molecules.indices()
+        velocities = molecules.read_velocities(ids)
+        slow = np.hypot(velocities[:, 0], velocities[:, 1]) < self.slow_speed
+        # Molecules already at the size limit cannot grow any further, frozen ones stay as they are.
+        slow &= (molecules.radii[ids] < self.max_radius) & ~molecules.frozen[ids]
+        ids, velocities = ids[slow], velocities[slow]
+        if len(ids) < 2:
+            return None
+
+        positions = molecules.read_positions(ids)
+        first, second = self.find_pairs(positions, molecules.radii[ids], molecules.densities[ids])
+        if len(first) == 0:
+            return None
+
+        a, b = ids[first], ids[second]
+        mass_a = molecules.masses[a].astype(np.float64)[:, None]
+        mass_b = molecules.masses[b].astype(np.float64)[:, None]
+        mass = mass_a + mass_b
+        position = (positions[first] * mass_a + positions[second] * mass_b) / mass
+        velocity = (velocities[first] * mass_a + velocities[second] * mass_b) / mass
+        radius = np.minimum(np.hypot(molecules.radii[a], molecules.radii[b]), self.max_radius)
+
+        removed = np.concatenate((a, b))
+        molecules.remove_many(removed)
+        merged = molecules.add_many(radius, mass[:, 0], position, velocity)
+        self.inherit_waves(a, b, merged, removed)
+        self.merged += len(a)
+        return removed, merged
+
+    def find_pairs(self, positions, radii, densities):
+        """Mutually nearest pairs of touching molecules with similar density, as two index arrays."""
+        reach = 2 * float(radii.max()) + self.contact_gap
+        # One cell of padding on every side, so that neighbour lookups never leave the grid.
+        cells = (positions // reach).astype(np.intp)
+        cells -= cells.min(axis=0) - 1
+        columns = int(cells[:, 0].max()) + 2
+        keys = cells[:, 1] * columns + cells[:, 0]
+
+        # A dense (cell, slot) table of candidate indices, -1 where empty.
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        starts = np.searchsorted(sorted_keys, sorted_keys)
+        slots = np.arange(len(keys)) - starts
+        table = np.full(((int(cells[:, 1].max()) + 2) * columns, int(slots.max()) + 1), -1, dtype=np.intp)
+        table[sorted_keys, slots] = order
+
+        first = []
+        second = []
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                neighbours = table[keys + dy * columns + dx]
+                for slot in range(neighbours.shape[1]):
+                    other = neighbours[:, slot]
+                    # Every pair once, from its lower index.
+                    valid = other > np.arange(len(keys))
+                    first.append(np.flatnonzero(valid))
+                    second.append(other[valid])
+        first = np.concatenate(first)
+        second = np.concatenate(second)
+
+        diff = positions[first] - positions[second]
+        distance = np.hypot(diff[:, 0], diff[:, 1])
+        touching = distance <= radii[first] + radii[second] + self.contact_gap
+        similar = np.abs(densities[first] - densities[second]) <= self.density_tolerance
+        keep = touching & similar
+        first, second, distance = first[keep], second[keep], distance[keep]
+        if len(first) == 0:
+            return first, second
+
+        # The nearest partner of every molecule, then only the pairs that chose each other.
+        both = np.concatenate((first, second))
+        partner = np.concatenate((second, first))
+        order = np.lexsort((np.concatenate((distance, distance)), both))
+        both, partner = both[order], partner[order]
+        head = np.ones(len(both), dtype=bool)
+        head[1:] = both[1:] != both[:-1]
+        nearest = np.full(len(positions), -1, dtype=np.intp)
+        nearest[both[head]] = partner[head]
+
+        first = np.flatnonzero(nearest >= 0)
+        second = nearest[first]
+        mutual = (nearest[second] == first) & (first < second)
+        return first[mutual], second[mutual]
+
+    def inherit_waves(self, a, b, merged, removed):
+        # A wave does not push a merged molecule again if it already pushed one of its parts.
+        removed = removed.tolist()
+        for wave in self.waves:
+            influenced = wave.influenced_molecules
+            if not influenced:
+                continue
+            hit = [index for index, part_a, part_b in zip(merged.tolist(), a.tolist(), b.tolist())
+                   if part_a in influenced or part_b in influenced]
+            influenced.difference_update(removed)
+            influenced.update(hit)
@@ -0,0 +1,234 @@
+# particles/molecule_store.py
+from functools import lru_cache
+from itertools import chain
+from operator import attrgetter
+
+import numpy as np
+import pymunk
+
+from scenes.constants import MOLECULES_LAYER, MOLECULE_COLLISION
+
+
+@lru_cache(maxsize=4096)
+def moment_for(mass, radius):
+    # Molecules come in a handful of (mass, radius) combinations, compute each moment once.
+    return pymunk.moment_for_circle(mass, 0, radius)
+
+
+class MoleculeStore:
+    """Structure-of-arrays storage for all molecules, indexed by integer id.
+
+    Per-molecule attributes live in contiguous NumPy arrays; the only per-molecule Python
+    objects left are the pymunk body and shape, which carry their id as `body.molecule_id`.
+    Ids of removed molecules are recycled, so use `alive` (or `indices()`) to iterate.
+
+    Molecules in a frozen region (see scenes.regions) are asleep in pymunk and flagged in
+    `frozen`; their positions and velocities are read from the arrays instead of the bodies.
+
+    Impulses are not applied to bodies when they are queued. They are summed into `impulses`
+    and the affected ids are kept in a sparse queue, which `apply_impulses` flushes in a single
+    pass after `space.step`; steps without pending impulses cost nothing.
+    """
+
+    MAX_DENSITY = 5.0
+    # Shared by every molecule shape, ShapeFilter is immutable.
+    SHAPE_FILTER = pymunk.ShapeFilter(categories=MOLECULES_LAYER, mask=pymunk.ShapeFilter.ALL_MASKS())
+
+    def __init__(self, space, capacity=1024):
+        self.space = space
+        self.capacity = 0
+        self.size = 0  # High-water mark of used ids.
+        self.count = 0  # Number of alive molecules.
+        self.free_ids = []
+        self.pending_ids = []
+
+        self.positions = np.zeros((0, 2), dtype=np.float64)
+        self.velocities = np.zeros((0, 2), dtype=np.float64)
+        self.radii = np.zeros(0, dtype=np.float32)
+        self.masses = np.zeros(0, dtype=np.float32)
+        self.densities = np.zeros(0, dtype=np.float32)
+        self.colors = np.zeros((0, 3), dtype=np.uint8)
+        self.impulses = np.zeros((0, 2), dtype=np.float64)
+        self.has_impulse = np.zeros(0, dtype=bool)
+        self.alive = np.zeros(0, dtype=bool)
+        self.frozen = np.zeros(0, dtype=bool)
+        self.bodies = []
+        self.shapes = []
+
+        self.grow(capacity)
+
+    def __len__(self):
+        return self.count
+
+    def grow(self, capacity):
+        if capacity <= self.capacity:
+            return
+        extra = capacity - self.capacity
+
+        def extend(array):
+            padding = np.zeros((extra,) + array.shape[1:], dtype=array.dtype)
+            return np.concatenate((array, padding))
+
+        self.positions = extend(self.positions)
+        self.velocities = extend(self.velocities)
+        self.radii = extend(self.radii)
+        self.masses = extend(self.masses)
+        self.densities = extend(self.densities)
+        self.colors = extend(self.colors)
+        self.impulses = extend(self.impulses)
+        self.has_impulse = extend(self.has_impulse)
+        self.alive = extend(self.alive)
+        self.frozen = extend(self.frozen)
+        self.bodies.extend([None] * extra)
+        self.shapes.extend([None] * extra)
+        self.capacity = capacity
+
+    def allocate_id(self):
+        if self.free_ids:
+            return self.free_ids.pop()
+        if self.size == self.capacity:
+            self.grow(max(1024, self.capacity * 2))
+        self.size += 1
+        return self.size - 1
+
+    @classmethod
+    def create_body(cls, radius, mass, position, body_type=pymunk.Body.DYNAMIC):
+        """A molecule body and its shape, not yet added to any space."""
+        body = pymunk.Body(mass, moment_for(mass, radius), body_type)
+        body.position = position
+
+        shape = pymunk.Circle(body, radius)
+        shape.friction = 0.001
+        shape.elasticity = 0.9
+        shape.collision_type = MOLECULE_COLLISION
+        shape.filter = cls.SHAPE_FILTER
+        return body, shape
+
+    def add_many(self, radii, masses, positions, velocities=None, colors=None):
+        """Add a batch of molecules with one `space.add` call; returns their ids.
+
+        Large batches are better split by the caller (see `scenes.spawner.spawn_lattice`), which
+        keeps the argument list of `space.add` bounded.
+
+        The ids are taken from the end of the store, the free list is left alone.
+        """
+        count = len(radii)
+        start = self.size
+        if start + count > self.capacity:
+            self.grow(max(start + count, 2 * self.capacity))
+        indices = np.arange(start, start + count)
+
+        self.positions[indices] = positions
+        self.velocities[indices] = 0 if velocities is None else velocities
+        self.radii[indices] = radii
+        self.masses[indices] = masses
+        self.densities[indices] = self.calculate_density(self.masses[indices], self.radii[indices])
+        self.colors[indices] = self.color_for_density(self.densities[indices]) if colors is None else colors
+
+        objects = []
+        velocity_list = self.velocities[indices].tolist()
+        for index, radius, mass, position, velocity in zip(indices.tolist(), self.radii[indices].tolist(),
+                                                           self.masses[indices].tolist(),
+                                                           self.positions[indices].tolist(), velocity_list):
+            body, shape = self.create_body(radius, mass, position)
+            body.velocity = velocity
+            body.molecule_id = index
+            self.bodies[index] = body
+            self.shapes[index] = shape
+            objects.append(body)
+            objects.append(shape)
+        self.space.add(*objects)
+
+        self.alive[indices] = True
+        self.frozen[indices] = False
+        self.size += count
+        self.count += count
+        return indices
+
+    def remove_many(self, indices):
+        """Remove a batch of molecules with one `space.remove` call."""
+        indices = np.asarray(indices, dtype=np.intp)
+        objects = []
+        for index in indices.tolist():
+            objects.append(self.bodies[index])
+            objects.append(self.shapes[index])
+            self.bodies[index] = None
+            self.shapes[index] = None
+        self.space.remove(*objects)
+
+        self.alive[indices] = False
+        self.frozen[indices] = False
+        # A queued impulse stays in the pending queue but no longer applies to anything.
+        self.impulses[indices] = 0
+        self.free_ids.extend(indices.tolist())
+        self.count -= len(indices)
+
+    def indices(self):
+        return np.flatnonzero(self.alive[:self.size])
+
+    def sync(self, indices=None):
+        """Copy positions and velocities of the given (default: all alive) molecules from pymunk."""
+        if indices is None:
+            indices = self.indices()
+        self.positions[indices] = self.read_positions(indices)
+        self.velocities[indices] = self.read_velocities(indices)
+        return indices
+
+    def read_positions(self, indices):
+        """Current positions of the given molecules as an (n, 2) array."""
+        return self.read_bodies(indices, 'position', self.positions)
+
+    def read_velocities(self, indices):
+        return self.read_bodies(indices, 'velocity', self.velocities)
+
+    def read_bodies(self, indices, attribute, array):
+        # Frozen molecules do not move, their values are taken from the array.
+        frozen = self.frozen[indices]
+        if frozen.any():
+            values = array[indices]
+            values[~frozen] = self.read_bodies(indices[~frozen], attribute, array)
+            return values
+        bodies = self.bodies
+        get = attrgetter(attribute)
+        flat = chain.from_iterable([get(bodies[index]) for index in indices.tolist()])
+        return np.fromiter(flat, dtype=np.float64, count=2 * len(indices)).reshape(-1, 2)
+
+    def queue_impulses(self, indices, impulses):
+        """Queue a batch of impulses, summing those that hit the same molecule."""
+        np.add.at(self.impulses, indices, impulses)
+        new_ids = np.unique(indices[~self.has_impulse[indices]])
+        self.has_impulse[new_ids] = True
+        self.pending_ids.extend(new_ids.tolist())
+
+    def apply_impulses(self):
+        if not self.pending_ids:
+            return 0
+        pending = np.array(self.pending_ids, dtype=np.intp)
+        self.pending_ids = []
+
+        # An impulse J at the centre of mass changes the velocity by J / m. Setting the velocity
+        # also wakes up sleeping bodies, like apply_impulse does.
+        delta_v = (self.impulses[pending] / self.masses[pending, None]).tolist()
+        bodies = self.bodies
+        for index, (dvx, dvy) in zip(pending.tolist(), delta_v):
+            body = bodies[index]
+            if body is not None:
+                vx, vy = body.velocity
+                body.velocity = (vx + dvx, vy + dvy)
+
+        self.impulses[pending] = 0
+        self.has_impulse[pending] = False
+        return len(pending)
+
+    @staticmethod
+    def calculate_density(mass, radius):
+        # Simplified density calculation, works on scalars and arrays alike.
+        return mass / radius
+
+    @classmethod
+    def color_for_density(cls, density):
+        density_ratio = np.minimum(np.asarray(density, dtype=np.float32) / cls.MAX_DENSITY, 1)  # Cap at 1.
+
+        # Interpolate between the start and end values for each color channel (a grey scale).
+        channel = (50 + density_ratio * (255 - 50)).astype(np.uint8)
+        return np.stack((channel, channel, channel), axis=-1)
@@ -0,0 +1,218 @@
+# particles/wave_engine.py
+import time
+
+import numpy as np
+import pymunk
+
+from particles.grid import Grid
+from scenes.constants import MOLECULES_LAYER
+
+
+class WaveEngine:
+    """Finds the molecules crossed by the wave fronts and queues their impulses.
+
+    Every step a wave sweeps the annulus between the radius it was last checked at and its
+    current radius (plus a small shell). The annuli of all waves are covered by grid cells, the
+    union of those cells is merged into row boxes and looked up once in the space's spatial hash,
+    and every wave then runs a vectorized distance test on the molecules found in its own cells.
+    The impulses of all waves are summed per molecule and queued as a single batch.
+
+    `max_waves` caps the number of active waves and `cell_budget` caps the cells swept per step.
+    Waves over the budget are swept on a later step, round-robin; since each wave remembers the
+    radius it was last checked at, they catch up without missing molecules. A wave whose annulus
+    alone is over the budget sweeps its inner part, at least a cell wide, and the rest on the
+    next steps.
+
+    With a `time_budget` (seconds per step), the cell budget follows from the measured cost of
+    a swept cell (picking the waves included), a running average, so the sweep takes about that
+    long whatever the number of waves and molecules. Without one, `cell_budget` stays fixed; replays set it from the log.
+
+    The reach of the waves (the radius they expired at and the molecules they pushed) is summed
+    up in `finished`, `total_reach`, `max_reach` and `pushed`.
+    """
+
+    MAX_IMPULSE = 1000  # Default cap of the impulse a molecule gets in one step.
+    SHELL = 5  # Half-thickness of the wave front, in pixels.
+    MIN_CELLS = 64  # The cell budget never drops below this, and moves in steps of it.
+
+    def __init__(self, space, molecules, world_width, world_height, cell_size=32,
+                 max_waves=256, cell_budget=2000, time_budget=0.005, max_impulse=MAX_IMPULSE):
+        self.space = space
+        self.max_impulse = max_impulse
+        self.molecules = molecules
+        self.grid = Grid(world_width, world_height, cell_size)
+        self.max_waves = max_waves
+        self.cell_budget = cell_budget
+        self.time_budget = time_budget
+        self.cell_cost = None  # Running average of the seconds a swept cell costs.
+        self.query_filter = pymunk.ShapeFilter(mask=MOLECULES_LAYER)
+        self.cell_mask = np.zeros(len(self.grid), dtype=bool)  # Scratch, kept all False.
+        self.waves = []
+        self.next_wave = 0  # Round-robin position for waves that went over the budget.
+        self.finished = 0
+        self.total_reach = 0.0
+        self.max_reach = 0.0
+        self.pushed = 0
+
+    def add(self, wave):
+        if len(self.waves) >= self.max_waves:
+            return False
+        self.waves.append(wave)
+        return True
+
+    def step(self, dt):
+        for wave in list(self.waves):
+            wave.update_physics(dt)
+            if wave.expired:
+                self.waves.remove(wave)
+                self.finished += 1
+                self.total_reach += wave.radius
+                self.max_reach = max(self.max_reach, wave.radius)
+        if not self.waves:
+            return
+
+        # Pick the waves to sweep this step, starting where the budget ran out last time.
+        started = time.perf_counter()
+        sweeps = []
+        cells_used = 0
+        count = len(self.waves)
+        start = self.next_wave % count
+        for offset in range(count):
+            wave = self.waves[(start + offset) % count]
+            inner = min(wave.swept_radius, wave.radius) - self.SHELL
+            outer = wave.radius + self.SHELL
+            cells = self.annulus_cells(wave.position, inner, outer)
+            if cells_used + len(cells) > self.cell_budget:
+                self.next_wave = start + offset
+                if sweeps:
+                    break
+                # Alone over the budget: the inner part of the annulus now, at least a cell wide.
+                outer = min(outer, max(inner + (outer - inner) * self.cell_budget / len(cells),
+                                       inner + 2 * self.SHELL + self.grid.cell_size))
+                cells = self.annulus_cells(wave.position, inner, outer)
+                wave.swept_radius = outer - self.SHELL
+                cells_used += len(cells)
+                sweeps.append((wave, inner, outer, cells))
+                break
+            cells_used += len(cells)
+            wave.swept_radius = wave.radius
+            sweeps.append((wave, inner, outer, cells))
+        else:
+            self.next_wave = 0
+
+        self.sweep(sweeps)
+        if self.time_budget is not None and cells_used:
+            self.adapt_budget((time.perf_counter() - started) / cells_used)
+
+    def adapt_budget(self, cell_cost):
+        # Smoothed and rounded, so that the budget (which a recording logs) changes now and then.
+        self.cell_cost = cell_cost if self.cell_cost is None else 0.9 * self.cell_cost + 0.1 * cell_cost
+        cells = int(self.time_budget / self.cell_cost) // self.MIN_CELLS * self.MIN_CELLS
+        self.cell_budget = max(self.MIN_CELLS, cells)
+
+    def sweep(self, sweeps):
+        """Test the molecules in the cells of the picked (wave, inner, outer, cells) and queue their impulses."""
+        indices, positions = self.query_cells(np.unique(np.concatenate([sweep[3] for sweep in sweeps])))
+        if len(indices) == 0:
+            return
+        candidate_cells = self.grid.cell_of(positions)
+
+        hit_indices = []
+        hit_impulses = []
+        for wave, inner, outer, cells in sweeps:
+            self.cell_mask[cells] = True
+            local = np.flatnonzero(self.cell_mask[candidate_cells])
+            self.cell_mask[cells] = False
+            if len(local) == 0:
+                continue
+
+            diff = positions[local] - (wave.position.x, wave.position.y)
+            distance = np.hypot(diff[:, 0], diff[:, 1])
+            hit = (distance >= inner) & (distance <= outer)
+            influenced = wave.influenced_molecules
+            if influenced:
+                hit &= np.fromiter((index not in influenced for index in indices[local].tolist()),
+                                   dtype=bool, count=len(local))
+            if not hit.any():
+                continue
+
+            wave_indices = indices[local[hit]]
+            strength = min(wave.impulse_strength, self.max_impulse)
+            hit_indices.append(wave_indices)
+            hit_impulses.append(diff[hit] / np.maximum(distance[hit], 1e-9)[:, None] * strength)
+            influenced.update(wave_indices.tolist())
+            self.pushed += len(wave_indices)
+
+        if hit_indices:
+            self.queue_superposition(np.concatenate(hit_indices), np.concatenate(hit_impulses))
+
+    def queue_superposition(self, indices, impulses):
+        """Sum the impulses of all waves per molecule, limit them and queue them in one batch."""
+        unique, inverse = np.unique(indices, return_inverse=True)
+        total = np.zeros((len(unique), 2), dtype=np.float64)
+        np.add.at(total, inverse, impulses)
+
+        # Limit the maximum impulse
+        magnitude = np.hypot(total[:, 0], total[:, 1])
+        scale = np.minimum(1.0, self.max_impulse / np.maximum(magnitude, 1e-9))
+        self.molecules.queue_impulses(unique, total * scale[:, None])
+
+    def annulus_cells(self, center, inner, outer):
+        """Flat ids (row * columns + column) of the grid cells that intersect the annulus."""
+        cell = self.grid.cell_size
+        cx, cy = center
+        left = max(0, int((cx - outer) // cell))
+        right = min(self.grid.columns - 1, int((cx + outer) // cell))
+        bottom = max(0, int((cy - outer) // cell))
+        top = min(self.grid.rows - 1, int((cy + outer) // cell))
+        if left > right or bottom > top:
+            return np.zeros(0, dtype=np.intp)
+
+        columns = np.arange(left, right + 1)
+        rows = np.arange(bottom, top + 1)
+        x0, y0 = np.meshgrid(columns * cell, rows * cell)
+        x1, y1 = x0 + cell, y0 + cell
+
+        # Nearest and farthest distance from the centre to every cell.
+        near_x = np.maximum(np.maximum(x0 - cx, cx - x1), 0)
+        near_y = np.maximum(np.maximum(y0 - cy, cy - y1), 0)
+        far_x = np.maximum(np.abs(x0 - cx), np.abs(x1 - cx))
+        far_y = np.maximum(np.abs(y0 - cy), np.abs(y1 - cy))
+        selected = (np.hypot(near_x, near_y) <= outer) & (np.hypot(far_x, far_y) >= max(inner, 0))
+
+        row_ids, column_ids = np.nonzero(selected)
+        return (rows[row_ids] * self.grid.columns + columns[column_ids]).astype(np.intp)
+
+    def cell_boxes(self, cells):
+        """Merge sorted flat cell ids into boxes (left, bottom, right, top), one per run in a row."""
+        if len(cells) == 0:
+            return []
+        # A run breaks where the ids are not consecutive or a new row starts.
+        breaks = np.flatnonzero((np.diff(cells) != 1) | (cells[1:] % self.grid.columns == 0))
+        starts = np.concatenate(([cells[0]], cells[breaks + 1]))
+        ends = np.concatenate((cells[breaks], [cells[-1]]))
+
+        cell = self.grid.cell_size
+        boxes = []
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            row, first = divmod(start, self.grid.columns)
+            last = end % self.grid.columns
+            boxes.append((first * cell, row * cell, (last + 1) * cell, (row + 1) * cell))
+        return boxes
+
+    def query_cells(self, cells):
+        """Ids and positions of the molecules in the given (sorted) cells."""
+        seen = set()
+        indices = []
+        positions = []
+        for box in self.cell_boxes(cells):
+            for shape in self.space.bb_query(pymunk.BB(*box), self.query_filter):
+                body = shape.body
+                molecule_id = getattr(body, 'molecule_id', None)
+                if molecule_id is None or molecule_id in seen:
+                    continue
+                seen.add(molecule_id)
+                indices.append(molecule_id)
+                positions.append(body.position)
+
+        return np.array(indices, dtype=np.intp), np.array(positions, dtype=np.float64).reshape(-1, 2)
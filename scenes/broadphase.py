@@ -0,0 +1,112 @@
+import numpy as np
+
+
+def molecule_diameters(molecules, oversize=4.0):
+    """Diameters of the alive molecules, without the ones over `oversize` times the median.
+
+    A few huge shapes would pull the average cell size far away from what suits all the others,
+    so they are left out of the cell size estimate.
+    """
+    diameters = 2 * molecules.radii[molecules.indices()].astype(np.float64)
+    if len(diameters) == 0:
+        return diameters
+    return diameters[diameters <= oversize * np.median(diameters)]
+
+
+def suggest(molecules, min_count=10000):
+    """A spatial hash (dim, count) for the molecules: cells the size of an average molecule and
+    about ten cells per molecule, as pymunk recommends."""
+    diameters = molecule_diameters(molecules)
+    dim = round(float(diameters.mean()), 2) if len(diameters) else 10.0
+    return dim, max(min_count, 10 * len(molecules))
+
+
+class BroadphaseTuner:
+    """Benchmarks spatial hash settings on live physics steps and keeps the fastest.
+
+    A tuning run first tries cell sizes around the suggested one (and the current setting),
+    then table sizes for the best cell size. Each candidate is switched in for `settle_steps`
+    plus `trial_steps` steps of the running simulation, and scored by the median `space.step`
+    time of the latter. The simulation keeps running throughout, the candidates only change
+    how fast it steps.
+
+    A run starts on `start` (from any thread), and by itself when the molecule count moved more
+    than `retune_change` away from the count of the last run.
+    """
+
+    DIM_FACTORS = (0.75, 1.0, 1.5, 2.0, 3.0)
+    COUNT_FACTORS = (0.5, 2.0)
+
+    def __init__(self, scene, trial_steps=20, settle_steps=3, retune_change=0.25, check_interval=600):
+        self.scene = scene
+        self.trial_steps = trial_steps
+        self.settle_steps = settle_steps
+        self.retune_change = retune_change
+        self.check_interval = check_interval
+        self.enabled = True
+        self.requested = False
+        self.active = False
+        self.stage = None
+        self.queue = []
+        self.candidate = None
+        self.samples = []
+        self.results = {}
+        self.tuned_count = None
+        self.steps = 0
+
+    def start(self):
+        self.requested = True
+
+    def step(self, seconds):
+        """Called on the physics thread after every space.step, with how long it took."""
+        if not self.enabled:
+            return
+        self.steps += 1
+        if self.steps % self.check_interval == 0 and self.tuned_count:
+            change = abs(len(self.scene.molecules) - self.tuned_count) / self.tuned_count
+            self.requested |= change > self.retune_change
+        if self.requested and not self.active:
+            self.requested = False
+            self.begin()
+            return
+        if not self.active:
+            return
+
+        self.samples.append(seconds)
+        if len(self.samples) < self.settle_steps + self.trial_steps:
+            return
+        self.results[self.candidate] = float(np.median(self.samples[self.settle_steps:]))
+        self.next()
+
+    def begin(self):
+        scene = self.scene
+        dim, count = suggest(scene.molecules)
+        dims = {round(dim * factor, 2) for factor in self.DIM_FACTORS}
+        self.queue = [(scene.hash_dim, count)] + [(candidate, count) for candidate in sorted(dims - {scene.hash_dim})]
+        self.stage = 'dim'
+        self.results = {}
+        self.tuned_count = len(scene.molecules)
+        self.active = True
+        self.next()
+
+    def next(self):
+        if not self.queue and self.stage == 'dim':
+            dim, count = self.best()
+            self.queue = [(dim, int(count * factor)) for factor in self.COUNT_FACTORS]
+            self.stage = 'count'
+        if not self.queue:
+            self.active = False
+            self.candidate = self.best()
+        else:
+            self.candidate = self.queue.pop(0)
+            self.samples = []
+        dim, count = self.candidate
+        # Applied before the next step, like every other change of the space settings.
+        self.scene.request_space_settings(hash_dim=dim, hash_count=count)
+
+    def best(self):
+        return min(self.results, key=self.results.get)
+
+    def report(self):
+        """Median space.step seconds per (dim, count) tried in the last run."""
+        return dict(self.results)
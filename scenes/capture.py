@@ -0,0 +1,152 @@
+import os
+import queue
+import shlex
+import struct
+import subprocess
+import threading
+import zlib
+
+import numpy as np
+import pygame
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(data, zlib.crc32(kind)))
+
+
+def write_png(path, rows, width, height, level=1):
+    """Write an RGB image given as rows prefixed with their PNG filter byte, (height, 1 + 3 * width).
+
+    zlib releases the GIL while it compresses, unlike pygame.image.save, so encoding on a writer
+    thread does not hold up the other threads.
+    """
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)  # 8-bit RGB, no interlace.
+    with open(path, 'wb') as file:
+        file.write(b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', header)
+                   + png_chunk(b'IDAT', zlib.compress(rows.data, level)) + png_chunk(b'IEND', b''))
+
+
+class FrameCapture:
+    """Records the composed screen to a PNG sequence, a raw RGB file or an encoder's stdin.
+
+    The render thread only copies the 32-bit pixels of the screen into one of `pool_size`
+    reusable buffers and queues it; a writer thread converts them to RGB, encodes and writes the
+    frames in order and hands the buffers back. When the writer falls behind and no buffer is
+    free, the frame is dropped instead of waiting, so the render loop never blocks on the disk.
+    Offline captures, which have no frame rate to keep, pass `drop=False` to wait instead.
+
+    The target picks the format: a path ending in .png is a pattern for an image sequence
+    (`{}` is replaced by the frame number, or one is added before the extension), anything else
+    is a file the frames are appended to as raw RGB24 rows. With a `command`, the raw frames
+    are piped to its stdin instead, e.g.
+    "ffmpeg -f rawvideo -pix_fmt rgb24 -s {width}x{height} -r 60 -i - run.mp4".
+    """
+
+    MASKS = (0xff0000, 0xff00, 0xff, 0)  # Pixel layout of the buffers, XRGB.
+
+    def __init__(self, target, size, command=None, pool_size=8, interval=1, drop=True):
+        self.target = target
+        self.width, self.height = size
+        self.interval = interval
+        self.drop = drop
+        self.frames = 0  # Frames offered to `capture`.
+        self.captured = 0
+        self.dropped = 0
+        self.written = 0
+        self.error = None
+
+        self.free = queue.Queue()
+        for _ in range(pool_size):
+            self.free.put(np.zeros((self.height, self.width), dtype=np.uint32))
+        self.pending = queue.Queue()
+        # Surfaces with another pixel layout are blitted here first.
+        self.scratch = None
+        # The writer's RGB frame, inside PNG rows that start with a filter byte of 0 (none).
+        self.rows = np.zeros((self.height, 1 + 3 * self.width), dtype=np.uint8)
+        self.rgb = self.rows[:, 1:]
+        self.rgb.shape = (self.height, self.width, 3)
+
+        self.file = None
+        self.process = None
+        self.png = command is None and target.lower().endswith('.png')
+        if command is not None:
+            args = [arg.format(width=self.width, height=self.height) for arg in shlex.split(command)]
+            self.process = subprocess.Popen(args, stdin=subprocess.PIPE)
+            self.file = self.process.stdin
+        else:
+            os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+            if not self.png:
+                self.file = open(target, 'wb')
+            elif '{' not in target:
+                root, extension = os.path.splitext(target)
+                self.target = root + '_{:06d}' + extension
+
+        self.writer = threading.Thread(target=self.write_frames, daemon=True)
+        self.writer.start()
+
+    def capture(self, surface):
+        """Queue a copy of the surface; False if the frame was skipped or dropped."""
+        self.frames += 1
+        if (self.frames - 1) % self.interval or self.error is not None:
+            return False
+        try:
+            buffer = self.free.get(block=not self.drop)
+        except queue.Empty:
+            self.dropped += 1
+            return False
+
+        if surface.get_bitsize() != 32 or surface.get_masks() != self.MASKS:
+            if self.scratch is None:
+                self.scratch = pygame.Surface((self.width, self.height), 0, 32, self.MASKS)
+            self.scratch.blit(surface, (0, 0))
+            surface = self.scratch
+        # surfarray is indexed (x, y), so its transpose is the surface memory row by row.
+        pixels = pygame.surfarray.pixels2d(surface)
+        try:
+            buffer[:] = pixels[:self.width, :self.height].T
+        finally:
+            # The pixel array locks the surface until it is released.
+            del pixels
+        self.pending.put((self.captured, buffer))
+        self.captured += 1
+        return True
+
+    def write_frames(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            number, buffer = item
+            try:
+                if self.error is None:
+                    self.write(number, buffer)
+                    self.written += 1
+            except OSError as error:
+                # A full disk or a closed encoder stops the capture, the simulation goes on.
+                self.error = error
+            finally:
+                self.free.put(buffer)
+
+    def write(self, number, buffer):
+        # Little-endian XRGB is stored as B, G, R, X.
+        np.copyto(self.rgb, buffer.view(np.uint8).reshape(self.height, self.width, 4)[:, :, 2::-1])
+        if self.png:
+            write_png(self.target.format(number), self.rows, self.width, self.height)
+        else:
+            self.file.write(np.ascontiguousarray(self.rgb).data)
+
+    def close(self):
+        """Write the queued frames and close the output."""
+        self.pending.put(None)
+        self.writer.join()
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError as error:
+                self.error = self.error or error
+        if self.process is not None:
+            self.process.wait()
+
+    def report(self):
+        return {'captured': self.captured, 'written': self.written, 'dropped': self.dropped,
+                'size': (self.width, self.height), 'error': None if self.error is None else str(self.error)}
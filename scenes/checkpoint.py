@@ -0,0 +1,157 @@
+import json
+import struct
+
+import numpy as np
+
+from particles.wave import Wave
+
+# File layout: MAGIC, a little-endian uint32 header length, the JSON header, then the raw arrays,
+# each starting at a multiple of ALIGNMENT. The header lists every array with its dtype, shape
+# and offset, so that loading can memory-map them instead of reading the file.
+MAGIC = b'HLCKPT01'
+ALIGNMENT = 64
+VERSION = 1
+
+
+def aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write(path, header, arrays):
+    """Write a header dict and named arrays in the checkpoint layout."""
+    specs = {}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        arrays[name] = array
+        specs[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = aligned(offset + array.nbytes)
+    header = dict(header, arrays=specs)
+
+    encoded = json.dumps(header).encode('utf-8')
+    data_start = aligned(len(MAGIC) + 4 + len(encoded))
+    with open(path, 'wb') as file:
+        file.write(MAGIC)
+        file.write(struct.pack('<I', len(encoded)))
+        file.write(encoded)
+        for name, array in arrays.items():
+            file.seek(data_start + specs[name]['offset'])
+            file.write(array.tobytes())
+        file.truncate(data_start + offset)
+
+
+def read(path):
+    """The header dict and the named arrays, memory-mapped read-only."""
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a HyperLife checkpoint")
+        (length,) = struct.unpack('<I', file.read(4))
+        header = json.loads(file.read(length).decode('utf-8'))
+    if header.get('version') != VERSION:
+        raise ValueError(f"{path} has checkpoint version {header.get('version')}, expected {VERSION}")
+
+    data_start = aligned(len(MAGIC) + 4 + length)
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        shape = tuple(spec['shape'])
+        if 0 in shape:
+            arrays[name] = np.zeros(shape, dtype=spec['dtype'])
+        else:
+            arrays[name] = np.memmap(path, dtype=spec['dtype'], mode='r', shape=shape,
+                                     offset=data_start + spec['offset'])
+    return header, arrays
+
+
+def save(scene, path):
+    """Save the full simulation state of a GameScene. Call it from the physics thread."""
+    molecules = scene.molecules
+    ids = molecules.sync()
+    bodies = molecules.bodies
+    angles = np.fromiter((bodies[index].angle for index in ids.tolist()), dtype=np.float64, count=len(ids))
+    spins = np.fromiter((bodies[index].angular_velocity for index in ids.tolist()), dtype=np.float64, count=len(ids))
+
+    waves = []
+    influenced = []
+    for wave in scene.waves_active:
+        hits = np.fromiter(wave.influenced_molecules, dtype=np.int64, count=len(wave.influenced_molecules))
+        influenced.append(hits)
+        waves.append({
+            'radius': wave.radius,
+            'impulse_strength': wave.impulse_strength,
+            'position': list(wave.position),
+            'velocity': list(wave.velocity),
+            'rate': wave.rate,
+            'influence_range': wave.influence_range,
+            'swept_radius': wave.swept_radius,
+            'influenced': len(hits),
+        })
+
+    version, state, gauss = scene.random.getstate()
+    header = {
+        'version': VERSION,
+        'world': [scene.world_width, scene.world_height],
+        'molecules': len(ids),
+        'camera': [scene.camera_x, scene.camera_y],
+        'zoom': scene.zoom,
+        'game_speed': scene.game_speed,
+        'requested_speed': scene.requested_speed,
+        'accumulator': scene.stepper.accumulator,
+        'steps': scene.stepper.steps,
+        'random_state': [version, list(state), gauss],
+        'waves': waves,
+    }
+    arrays = {
+        'ids': ids.astype(np.int64),
+        'positions': molecules.positions[ids],
+        'velocities': molecules.velocities[ids],
+        'angles': angles,
+        'angular_velocities': spins,
+        'radii': molecules.radii[ids],
+        'masses': molecules.masses[ids],
+        'colors': molecules.colors[ids],
+        'wave_influenced': np.concatenate(influenced) if influenced else np.zeros(0, dtype=np.int64),
+    }
+    write(path, header, arrays)
+
+
+def load(scene, path):
+    """Restore a checkpoint into a GameScene whose space has walls but no molecules yet."""
+    header, arrays = read(path)
+    if header['world'] != [scene.world_width, scene.world_height]:
+        raise ValueError(f"{path} was saved for a {header['world']} world")
+
+    molecules = scene.molecules
+    new_ids = molecules.add_many(arrays['radii'], arrays['masses'], arrays['positions'],
+                                 arrays['velocities'], arrays['colors'])
+    bodies = molecules.bodies
+    for index, angle, spin in zip(new_ids.tolist(), arrays['angles'].tolist(), arrays['angular_velocities'].tolist()):
+        bodies[index].angle = angle
+        bodies[index].angular_velocity = spin
+    scene.molecules_count = len(new_ids)
+
+    # Molecule ids are compacted on load, translate the ones the waves already hit.
+    old_ids = np.asarray(arrays['ids'])
+    translate = np.full(int(old_ids.max()) + 1 if len(old_ids) else 0, -1, dtype=np.intp)
+    translate[old_ids] = new_ids
+    influenced = np.asarray(arrays['wave_influenced'])
+    start = 0
+    for state in header['waves']:
+        wave = Wave(state['radius'], state['impulse_strength'], state['velocity'], state['position'])
+        wave.rate = state['rate']
+        wave.influence_range = state['influence_range']
+        wave.swept_radius = state['swept_radius']
+        hits = translate[influenced[start:start + state['influenced']]]
+        wave.influenced_molecules.update(hits[hits >= 0].tolist())
+        start += state['influenced']
+        scene.wave_engine.add(wave)
+
+    scene.camera_x, scene.camera_y = header['camera']
+    scene.zoom = header['zoom']
+    # Through the slider's path, so that the slider shows the restored speed; then the speed the
+    # load controller had lowered it to. Older checkpoints only have the latter.
+    scene.request_speed(header.get('requested_speed', header['game_speed']))
+    scene.game_speed = header['game_speed']
+    scene.stepper.accumulator = header['accumulator']
+    scene.stepper.steps = header['steps']
+    version, state, gauss = header['random_state']
+    scene.random.setstate((version, tuple(state), gauss))
@@ -1,55 +1,160 @@
 import random
+import time
+
+import numpy as np
 import pygame
 import pymunk
 
 from GUI.gui import Panel
-from particles.molecule import Molecule
+from particles.energy import EnergyMeter
+from particles.field import ForceField
+from particles.merge_engine import MergeEngine
+from particles.molecule_store import MoleculeStore
 from particles.wave import Wave
+from particles.wave_engine import WaveEngine
 from scenes.renderer import Renderer
+from scenes import broadphase, checkpoint
+from scenes.broadphase import BroadphaseTuner
+from scenes.load_controller import LoadController
+from scenes.metrics import PhaseTimer
+from scenes.regions import RegionMap
+from scenes.snapshot import SnapshotBuffer
+from scenes.spawner import spawn_lattice
+from scenes.visibility import VisibilityIndex
+from scenes.stepper import FixedStepper
 from scenes.constants import *
 from events import *
 
 
 class GameScene:
-    def __init__(self):
+    def __init__(self, headless=False, molecules_count=40000, seed=None, checkpoint_path=None, threads=6,
+                 damping=0.95, wave_radius=(500, 1000), wave_strength=(50, 150),
+                 max_impulse=WaveEngine.MAX_IMPULSE, field=None):
+        # Headless scenes have no window, panel or renderer and are stepped by the caller.
+        # With a checkpoint_path the world is restored from that checkpoint instead of generated.
+        self.headless = headless
+        # Simulation parameters, the wave ranges are the (low, high) bounds new waves are drawn from.
+        self.threads = threads
+        self.damping = damping
+        self.wave_radius = wave_radius
+        self.wave_strength = wave_strength
+        self.max_impulse = max_impulse
+        # The kind of long-range ForceField ('gravity', 'pressure'), or None for none.
+        self.field_kind = field
+        # Runs are always seeded, so that any of them can be recorded and replayed.
+        self.seed = random.randrange(2 ** 32) if seed is None else seed
+        self.random = random.Random(self.seed)
+        self.checkpoint_path = checkpoint_path
+        # A scenes.replay.Recorder that logs the inputs of every physics step.
+        self.recorder = None
+        # A scenes.capture.FrameCapture that gets every rendered frame.
+        self.capture = None
+        self.timer = PhaseTimer()
+        # Phases of the render thread, kept apart since every PhaseTimer has a single writer.
+        self.render_timer = PhaseTimer()
+        # Time spent in each phase of the cold start.
+        self.startup_timer = PhaseTimer()
         self.refresh_waves = False
+        self.checkpoint_request = None
+        # Set on the slow-update cadence, the physics thread then measures the energy statistics.
+        self.energy_request = False
+        self.energy = None
         self.move_down = None
         self.move_up = None
         self.move_right = None
         self.move_left = None
+        self.zoom_in = None
+        self.zoom_out = None
         self.view_port = None
         self.fps = 60
         self.psu = 60
         self.game_speed = 1
+        # The speed picked with the slider, the load controller keeps game_speed at or below it.
+        self.requested_speed = 1
         self.screen = None
+        self.screen_width = 1200
+        self.screen_height = 800
         self.world_width = 5000
         self.world_height = 5000
-        self.molecule_layer = None
-        self.molecules_count = 40000
+        # The lattice may hold fewer molecules than requested, replays need the requested count.
+        self.molecules_requested = molecules_count
+        self.molecules_count = molecules_count
         self.space = None
+        # Spatial hash cell size and table size, and a pending change of them or of the thread count.
+        self.hash_dim = 10
+        self.hash_count = 400000
+        self.space_settings_request = None
         self.camera_x = 0
         self.camera_y = 0
+        # World to screen scale, below lod_zoom molecules are drawn as a density heatmap.
+        self.zoom = 1.0
+        self.max_zoom = 4.0
+        self.lod_zoom = 0.5
+        self.capture_lod = False
         self.panel = None
-        self.world = None
         self.walls = None
-        self.molecules = {}
-        self.visible_molecules = []
-        self.renderer = Renderer(self)
+        self.molecules = None
+        self.wave_engine = None
+        self.visibility = None
+        self.energy_meter = None
+        self.merge_engine = None
+        self.regions = None
+        self.field = None
+        self.broadphase = None
+        # Visible molecule ids and their positions before the last physics step.
+        self.visible_molecules = np.zeros(0, dtype=np.intp)
+        self.visible_previous = np.zeros((0, 2))
+        # What the render thread draws, it never touches pymunk objects.
+        self.snapshots = SnapshotBuffer()
+        self.renderer = None if headless else Renderer(self)
         self.physics_slow_steps = 0
+        self.stepper = FixedStepper(self)
+        self.load_controller = None if headless else LoadController(self)
 
         # Init everything.
-        self.init_game()
-        self.init_world()
+        startup = self.startup_timer
+        if not headless:
+            with startup.phase('display'):
+                self.init_game()
+        with startup.phase('world'):
+            self.init_world()
         # Fill the world.
-        self.setup_collisions()
-        self.init_molecules()
-
-        self.waves_active = []
-        pygame.time.set_timer(WAVE_INIT_EVENT, 5000)
+        if checkpoint_path is None:
+            with startup.phase('molecules'):
+                self.init_molecules()
+        else:
+            self.molecules = MoleculeStore(self.space, self.molecules_count)
+
+        with startup.phase('engines'):
+            self.wave_engine = WaveEngine(self.space, self.molecules, self.world_width, self.world_height,
+                                          max_impulse=self.max_impulse)
+            self.visibility = VisibilityIndex(self.space, self.world_width, self.world_height)
+            self.energy_meter = EnergyMeter(self.world_width, self.world_height)
+            self.waves_active = self.wave_engine.waves
+            self.merge_engine = MergeEngine(self.molecules, self.waves_active)
+            self.regions = RegionMap(self)
+            if field is not None:
+                self.field = ForceField(self.world_width, self.world_height, field)
+                # A global force never lets a region settle, and would not reach frozen ones.
+                self.regions.enabled = False
+        if checkpoint_path is not None:
+            with startup.phase('checkpoint'):
+                checkpoint.load(self, checkpoint_path)
+        # The hash is sized for the molecules now in the space, then benchmarked on the first steps.
+        with startup.phase('broadphase'):
+            self.broadphase = BroadphaseTuner(self)
+            hash_dim, hash_count = broadphase.suggest(self.molecules)
+            self.apply_space_settings(hash_dim=hash_dim, hash_count=hash_count)
+            self.broadphase.start()
+        # PSU is measured from the step count between slow updates.
+        self.psu_steps = self.stepper.steps
+        self.psu_time = time.perf_counter()
+        if not headless:
+            pygame.time.set_timer(WAVE_INIT_EVENT, 5000)
 
     def init_game(self):
         self.game_speed = 1
-        self.screen = pygame.display.set_mode((1200, 800))
+        self.screen = pygame.display.set_mode((self.screen_width, self.screen_height))
         icon = pygame.image.load('assets/images/icon.png')
 
         # Set an icon in the center of the screen while the game is loading
@@ -67,66 +172,40 @@ class GameScene:
         # Set the window caption
         pygame.display.set_caption("HyperLife 1.0 - Sandbox")
 
+    def init_offscreen(self):
+        # Headless scenes draw into a plain surface when their frames are captured.
+        self.screen = pygame.Surface((self.screen_width, self.screen_height))
+        self.renderer = Renderer(self)
+        self.renderer.interpolate = False
+
     def init_world(self):
-        self.molecule_layer = pygame.Surface((self.world_width, self.world_height), pygame.SRCALPHA)
         self.space = pymunk.Space(threaded=True)
-        self.space.threads = 6
-        self.space.use_spatial_hash(10, 400000)
-        self.space.damping = 0.95
+        self.space.threads = self.threads
+        self.space.use_spatial_hash(self.hash_dim, self.hash_count)
+        self.space.damping = self.damping
         self.space.sleep_time_threshold = 0.1
         self.space.idle_speed_threshold = 0.01
 
-        # Add world and walls
-        self.world = pygame.Surface((self.world_width + self.panel.width, self.world_height))
+        # Add walls
         self.walls = self.add_walls()
 
     def init_molecules(self):
-        padding = 100  # Padding from walls
-        radius = 2  # Radius of molecule
-
-        # Calculate the area of the simulation space
-        width = self.world_width - 2 * padding
-        height = self.world_height - 2 * padding
-
-        # Compute the number of molecules in one dimension
-        molecule_count_one_dim = int((self.molecules_count ** 0.5))
-
-        # Calculate the gap and distance between molecules
-        gap = min(width, height) / molecule_count_one_dim - 2 * radius
-        distance = 2 * radius + gap
-
-        # Adjust the molecule count in one dimension based on the actual gap
-        horizontal_molecule_count = int(width // distance)
-        vertical_molecule_count = int(height // distance)
-
-        # The actual number of molecules may be less than the requested due to rounding down
-        self.molecules_count = horizontal_molecule_count * vertical_molecule_count
-
-        for i in range(horizontal_molecule_count):
-            for j in range(vertical_molecule_count):
-                position = (padding + distance * i + distance // 2, padding + distance * j + distance // 2)
-
-                mass = random.randint(1, 10)
-                molecule_radius = random.randint(2, 5)
-                molecule = Molecule(self.space, molecule_radius, mass, None, position)
-                impulse = pymunk.Vec2d(random.uniform(-100, 100), random.uniform(-100, 100))
-                molecule.apply_impulse(impulse)
-
-                self.molecules[molecule.id] = molecule
+        # The lattice and the random attributes are generated as arrays, the bodies are added in batches.
+        # The NumPy generator is seeded from the scene's random, so a seed still reproduces the world.
+        rng = np.random.default_rng(self.random.getrandbits(64))
+        self.molecules = MoleculeStore(self.space, self.molecules_count)
+        self.molecules_count = spawn_lattice(self.molecules, rng, self.world_width, self.world_height,
+                                             self.molecules_count, self.startup_timer)
 
     def init_waves(self):
-        # Reduce just to 1 wave at a time.
-        radius = random.randint(500, 1000)  # Adjust this range as needed
-        impulse_strength = random.randint(50, 150)  # Adjust this range as needed
-        position = (random.randint(0, self.world_width), random.randint(0, self.world_height))
+        radius = self.random.randint(*self.wave_radius)
+        impulse_strength = self.random.randint(*self.wave_strength)
+        position = (self.random.randint(0, self.world_width), self.random.randint(0, self.world_height))
         # position = (500, 500)
-        velocity = pymunk.Vec2d(random.randint(0, 0), random.randint(100, 100))
-        wave = Wave(self, self.space, radius, impulse_strength, velocity, position)
-        self.waves_active.append(wave)
-
-    def setup_collisions(self):
-        wave_collision_handler = self.space.add_collision_handler(WAVE_COLLISION, MOLECULE_COLLISION)
-        Wave.setup_wave_collision(wave_collision_handler)
+        velocity = pymunk.Vec2d(self.random.randint(0, 0), self.random.randint(100, 100))
+        wave = Wave(radius, impulse_strength, velocity, position)
+        if self.wave_engine.add(wave) and self.recorder is not None:
+            self.recorder.wave(self.stepper.steps, wave)
 
     def handle_input(self):
         # handle user input here
@@ -135,10 +214,8 @@ class GameScene:
         self.move_right = keys[pygame.K_RIGHT]
         self.move_up = keys[pygame.K_UP]
         self.move_down = keys[pygame.K_DOWN]
-
-        # Handle panel inputs
-        for event in pygame.event.get():
-            self.panel.process_events(event)
+        self.zoom_in = keys[pygame.K_EQUALS] or keys[pygame.K_KP_PLUS] or keys[pygame.K_PAGEUP]
+        self.zoom_out = keys[pygame.K_MINUS] or keys[pygame.K_KP_MINUS] or keys[pygame.K_PAGEDOWN]
 
     ############################
     # UPDATES, there are 3 types:
@@ -151,20 +228,65 @@ class GameScene:
         self.update_rest(dt)
 
     def update_physics(self, dt):
-        for _ in range(int(self.game_speed)):
-            self.space.step(dt)
+        # A single fixed step, the FixedStepper decides how many of them to run.
+        with self.timer.phase('physics'):
+            # Space settings are only changed between steps, on the physics side.
+            if self.space_settings_request is not None:
+                settings, self.space_settings_request = self.space_settings_request, None
+                self.apply_space_settings(**settings)
+
+            if self.recorder is not None:
+                with self.timer.phase('record'):
+                    self.recorder.step(self)
 
-            for molecule in self.molecules.values():
-                molecule.update_physics(dt)
+            with self.timer.phase('space.step'):
+                self.space.step(dt)
+            self.broadphase.step(self.timer.last('space.step'))
 
             # Create waves.
             if self.refresh_waves:
                 self.refresh_waves = False
                 self.init_waves()
 
-            # Clean up waves.
-            for wave in self.waves_active:
-                wave.update_physics(dt)
+            # Frozen regions are woken before a wave front reaches them, quiet ones are frozen.
+            with self.timer.phase('regions'):
+                self.regions.step()
+
+            with self.timer.phase('waves'):
+                # Move the wave fronts and queue impulses for the molecules they cross.
+                self.wave_engine.step(dt)
+
+            # Long-range forces, queued as impulses like the ones of the waves.
+            if self.field is not None and self.field.step():
+                with self.timer.phase('field'):
+                    self.field.apply(self.molecules, dt)
+
+            # Impulses queued by the waves and the field are applied in one pass.
+            with self.timer.phase('impulses'):
+                self.molecules.apply_impulses()
+
+            # Structural changes: merged molecules are removed and added in bulk.
+            if self.merge_engine.step():
+                with self.timer.phase('merge'):
+                    merged = self.merge_engine.merge()
+                    if merged is not None:
+                        self.replace_molecules(*merged)
+
+            # Checkpoints are written between steps, on the physics side.
+            if self.checkpoint_request is not None:
+                path, self.checkpoint_request = self.checkpoint_request, None
+                self.save_checkpoint(path)
+
+            # A measurement is spread over the following steps; requests during one are dropped.
+            if self.energy_request:
+                self.energy_request = False
+                if not self.energy_meter.active:
+                    self.energy_meter.begin(self.molecules)
+            if self.energy_meter.active:
+                with self.timer.phase('energy'):
+                    energy = self.energy_meter.advance(self.molecules)
+                if energy is not None:
+                    self.energy = energy
 
             # For slow physics updates.
             # self.physics_slow_steps += 1
@@ -172,49 +294,159 @@ class GameScene:
             # self.update_physics_slow()
             # self.physics_slow_steps = 1
 
-        # This is independent of physics updates, but relies on physics updates.
-        self.visible_molecules = self.get_molecules_in_viewport()
-
-        # for molecule in self.molecules.values():
-        #     molecule.update_physics(dt)
-        # self.space.step(0)
-        # for molecule in self.molecules.values():
-        #     molecule.handle_mergers()
+    def capture_previous(self):
+        # Called before the last step of a batch: pick the visible molecules and remember where they were.
+        with self.timer.phase('viewport'):
+            self.capture_lod = self.zoom < self.lod_zoom
+            if self.capture_lod:
+                # Zoomed out, no molecule is drawn, the heatmap bins the positions of all of them.
+                self.visible_molecules = np.zeros(0, dtype=np.intp)
+            else:
+                self.visible_molecules = self.get_molecules_in_viewport()
+            self.visible_previous = self.molecules.read_positions(self.visible_molecules)
+
+    def capture_current(self):
+        # Called after the last step of a batch, publishes the snapshot the renderer interpolates.
+        with self.timer.phase('viewport'):
+            ids = self.visible_molecules
+            count = len(ids)
+
+            snapshot = self.snapshots.begin_write()
+            snapshot.reserve(count)
+            snapshot.ids[:count] = ids
+            snapshot.previous[:count] = self.visible_previous
+            snapshot.current[:count] = self.molecules.read_positions(ids)
+            self.visibility.update_moved(ids, snapshot.current[:count])
+            snapshot.radii[:count] = self.molecules.radii[ids]
+            snapshot.colors[:count] = self.molecules.colors[ids]
+            snapshot.camera = (self.camera_x, self.camera_y)
+            snapshot.heatmap = self.visibility.heatmap(self.molecules) if self.capture_lod else None
+            snapshot.heatmap_cell = self.visibility.grid.cell_size
+            snapshot.accumulator = self.stepper.accumulator
+            snapshot.dt = self.stepper.dt
+            snapshot.game_speed = self.game_speed
+            self.snapshots.publish(snapshot)
 
     def update_slow(self):
+        now = time.perf_counter()
+        steps = self.stepper.steps
+        self.psu = (steps - self.psu_steps) / (now - self.psu_time)
+        self.psu_steps, self.psu_time = steps, now
+
+        # Read out once per slow update, a label changing every frame would redraw the panel every frame.
+        self.panel.set_fps_psu(int(self.fps), int(self.psu))
         self.panel.set_molecules_count(len(self.molecules))
         self.panel.set_waves_count(len(self.waves_active))
+        self.panel.set_frozen(*self.regions.frozen_count())
+        self.panel.set_broadphase(self.broadphase.active, self.broadphase.report())
+        self.panel.set_timings(dict(self.timer.report(), **self.render_timer.report()))
+        # Shows the statistics measured after the previous request.
+        if self.energy is not None:
+            self.panel.set_energy(self.energy)
+        self.energy_request = True
+        self.load_controller.update()
+
+    def view_size(self):
+        # The part of the world covered by the screen (left of the panel), in world pixels.
+        panel_width = self.panel.width if self.panel is not None else 0
+        return (self.screen_width - panel_width) / self.zoom, self.screen_height / self.zoom
+
+    def min_zoom(self):
+        # Far enough out to see the whole world at once.
+        panel_width = self.panel.width if self.panel is not None else 0
+        return min((self.screen_width - panel_width) / self.world_width, self.screen_height / self.world_height)
+
+    def set_zoom(self, zoom):
+        # Zoom around the centre of the view.
+        view_width, view_height = self.view_size()
+        center_x, center_y = self.camera_x + view_width / 2, self.camera_y + view_height / 2
+        self.zoom = min(self.max_zoom, max(self.min_zoom(), zoom))
+        view_width, view_height = self.view_size()
+        self.camera_x, self.camera_y = center_x - view_width / 2, center_y - view_height / 2
+        self.clamp_camera()
+
+    def clamp_camera(self):
+        view_width, view_height = self.view_size()
+        self.camera_x = min(max(self.camera_x, 0), max(0, self.world_width - view_width))
+        self.camera_y = min(max(self.camera_y, 0), max(0, self.world_height - view_height))
 
     def update_camera(self, dt):
-        camera_movement_speed = 500  # pixels per second
+        camera_movement_speed = 500 / self.zoom  # screen pixels per second
+        zoom_speed = 2  # zoom factor per second
+
+        if self.zoom_in:
+            self.set_zoom(self.zoom * zoom_speed ** dt)
+        if self.zoom_out:
+            self.set_zoom(self.zoom / zoom_speed ** dt)
 
         if self.move_left:
-            self.camera_x = max(self.camera_x - camera_movement_speed * dt, 0)
+            self.camera_x -= camera_movement_speed * dt
         if self.move_right:
-            self.camera_x = min(self.camera_x + camera_movement_speed * dt,
-                                self.world_height - self.screen.get_width() + self.panel.width)
+            self.camera_x += camera_movement_speed * dt
         if self.move_up:
-            self.camera_y = max(self.camera_y - camera_movement_speed * dt, 0)
+            self.camera_y -= camera_movement_speed * dt
         if self.move_down:
-            self.camera_y = min(self.camera_y + camera_movement_speed * dt,
-                                self.world_width - self.screen.get_height())
+            self.camera_y += camera_movement_speed * dt
+        self.clamp_camera()
 
     def update_rest(self, dt):
-        if self.fps < 10:
-            # Decrease, but don't go below 1.
-            self.game_speed = max(1, self.game_speed - 1)
-            self.panel.speed_slider.set_current_value(int(self.game_speed))
-
-        self.panel.set_fps_psu(int(self.fps), int(self.psu))
         self.panel.set_game_speed(int(self.game_speed))
         self.panel.update(dt)
 
-    def process_events(self, event):
-        self.panel.process_events(event)
+    def subscribe(self, events):
+        # The panel sees every event, the scene only the ones it acts on.
+        events.subscribe(self.panel.process_events)
+        events.subscribe(self.process_events, WAVE_INIT_EVENT, pygame.MOUSEWHEEL, pygame.KEYDOWN)
 
+    def process_events(self, event):
         if event.type == WAVE_INIT_EVENT:
-            if len(self.waves_active) == 0:
-                self.refresh_waves = True
+            self.request_wave()
+        elif event.type == pygame.MOUSEWHEEL:
+            self.set_zoom(self.zoom * 1.1 ** event.y)
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_F5:
+            self.checkpoint_request = 'quicksave.hlc'
+
+    def request_space_settings(self, **settings):
+        # Merged into any request the physics thread has not picked up yet.
+        self.space_settings_request = dict(self.space_settings_request or {}, **settings)
+
+    def apply_space_settings(self, threads=None, hash_dim=None, hash_count=None):
+        # Called on the physics side only, before a step. The settings change the order contacts
+        # are solved in, so a recording logs them.
+        if threads is not None:
+            self.space.threads = threads
+        if hash_dim is not None or hash_count is not None:
+            self.hash_dim = self.hash_dim if hash_dim is None else hash_dim
+            self.hash_count = self.hash_count if hash_count is None else hash_count
+            self.space.use_spatial_hash(self.hash_dim, self.hash_count)
+        if self.recorder is not None:
+            self.recorder.space_settings(self)
+
+    def replace_molecules(self, removed, added):
+        # Removed molecules leave the visibility index and the batch being captured for the renderer,
+        # added ones are filed under their cells right away, so they are drawn on the next query.
+        for index in removed.tolist():
+            self.visibility.forget(index)
+        self.visibility.add(added, self.molecules.positions[added])
+        keep = self.molecules.alive[self.visible_molecules]
+        self.visible_molecules = self.visible_molecules[keep]
+        self.visible_previous = self.visible_previous[keep]
+
+    def save_checkpoint(self, path):
+        with self.timer.phase('checkpoint'):
+            checkpoint.save(self, path)
+
+    def request_speed(self, speed):
+        """The speed picked with the slider; the load controller may run slower while overloaded."""
+        self.requested_speed = speed
+        self.game_speed = speed
+        if self.panel is not None:
+            self.panel.set_speed_slider(speed)
+
+    def request_wave(self):
+        # Waves are spawned on the physics side, on the next physics update. The wave engine
+        # caps the number of concurrent waves.
+        self.refresh_waves = True
 
     def render(self):
         self.renderer.render()
@@ -250,11 +482,10 @@ class GameScene:
         # Compute the extended viewport bounds, ensuring they don't exceed the world bounds
         extended_left = max(0, self.camera_x - extension)
         extended_bottom = max(0, self.camera_y - extension)
-        extended_right = min(self.world_width, self.camera_x + self.screen.get_width() + extension)
-        extended_top = min(self.world_height, self.camera_y + self.screen.get_height() + extension)
-
-        # Create the extended viewport bounding box
-        extended_viewport_bb = pymunk.BB(extended_left, extended_bottom, extended_right, extended_top)
-        shapes_in_viewport = self.space.bb_query(extended_viewport_bb, pymunk.ShapeFilter())
-        molecules_in_viewport = [shape.body.molecule for shape in shapes_in_viewport if hasattr(shape.body, 'molecule')]
-        return molecules_in_viewport
+        view_width, view_height = self.view_size()
+        extended_right = min(self.world_width, self.camera_x + view_width + extension)
+        extended_top = min(self.world_height, self.camera_y + view_height + extension)
+
+        # The visibility index only re-queries the cells that are new or stale.
+        molecules_in_viewport = self.visibility.query(extended_left, extended_bottom, extended_right, extended_top)
+        return molecules_in_viewport[self.molecules.alive[molecules_in_viewport]]
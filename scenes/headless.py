@@ -0,0 +1,99 @@
+import time
+
+from scenes.game_scene import GameScene
+
+
+class HeadlessRunner:
+    """Drives a window-less GameScene with a fixed-step loop.
+
+    Wave spawning normally comes from the WAVE_INIT_EVENT timer, which needs a display and
+    real time, so here it is scheduled on simulated time instead. Other keyword arguments are
+    GameScene parameters (threads, damping, wave ranges, max_impulse).
+
+    Nothing is culled or published for a renderer unless `render` is set, or frames are captured.
+    """
+
+    def __init__(self, molecules_count=40000, seed=0, dt=1 / 60, wave_interval=5.0, checkpoint_path=None,
+                 render=False, **parameters):
+        self.dt = dt
+        self.wave_interval = wave_interval
+        self.steps = 0
+        self.sim_time = 0.0
+        self.next_wave_time = wave_interval
+
+        start = time.perf_counter()
+        self.scene = GameScene(headless=True, molecules_count=molecules_count, seed=seed,
+                               checkpoint_path=checkpoint_path, **parameters)
+        self.init_time = time.perf_counter() - start
+        self.stepper = self.scene.stepper
+        self.stepper.dt = dt
+        self.stepper.publish = render
+
+    def start_capture(self, capture):
+        """Render every step into an offscreen surface and hand the frames to a FrameCapture."""
+        self.scene.init_offscreen()
+        self.scene.capture = capture
+        self.stepper.publish = True
+
+    def step(self):
+        if self.wave_interval and self.sim_time >= self.next_wave_time:
+            self.next_wave_time += self.wave_interval
+            self.scene.request_wave()
+
+        self.stepper.run_steps(1)
+        if self.scene.capture is not None:
+            self.scene.render()
+        self.sim_time += self.dt
+        self.steps += 1
+
+    def warm_up(self, steps):
+        """Run `steps` steps, and on until the BroadphaseTuner has picked its spatial hash; returns the steps run.
+
+        The tuner tries hash sizes on the live steps, so measuring before it is done would time its trials.
+        """
+        tuner = self.scene.broadphase
+        for _ in range(steps):
+            self.step()
+        while tuner.enabled and (tuner.active or tuner.requested):
+            self.step()
+            steps += 1
+        return steps
+
+    def energy_summary(self):
+        energy = self.scene.energy_meter.measure(self.scene.molecules)
+        return {name: energy[name] for name in ('kinetic_energy', 'mean_energy', 'momentum', 'max_speed')}
+
+    def wave_summary(self):
+        """How far the waves got: expired ones by their final radius, active ones so far."""
+        engine = self.scene.wave_engine
+        radii = [wave.radius for wave in engine.waves]
+        reached = engine.finished + len(radii)
+        return {
+            'spawned': reached,
+            'active': len(radii),
+            'mean_reach': (engine.total_reach + sum(radii)) / reached if reached else 0.0,
+            'max_reach': max([engine.max_reach] + radii),
+            'pushed': engine.pushed,
+        }
+
+    def run(self, steps, exporter=None, export_interval=60):
+        """Run `steps` fixed steps; a MetricsExporter gets the phase timings every `export_interval` steps."""
+        self.scene.timer.reset()
+        start = time.perf_counter()
+        for step in range(1, steps + 1):
+            self.step()
+            if exporter is not None and step % export_interval == 0:
+                exporter.write(self.stepper.steps, time.perf_counter() - start, self.scene.timer.report())
+        elapsed = time.perf_counter() - start
+
+        return {
+            'molecules': len(self.scene.molecules),
+            'steps': steps,
+            'elapsed': elapsed,
+            'steps_per_sec': steps / elapsed if elapsed > 0 else 0.0,
+            'init_time': self.init_time,
+            'startup': self.scene.startup_timer.report(),
+            'energy': self.energy_summary(),
+            'waves': self.wave_summary(),
+            'phases': self.scene.timer.report(),
+        }
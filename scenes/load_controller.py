@@ -0,0 +1,172 @@
+import numpy as np
+
+
+class LoadController:
+    """Keeps the simulation running as fast as the machine holds.
+
+    Once per slow update it compares the measured costs with two budgets: the physics thread
+    has to run `game_speed / dt` steps per second, and the render thread has `target_frame_time`
+    per frame. At most one setting is changed per update:
+
+    - Physics over budget: first try the other `space.threads` count, kept only if `space.step`
+      got cheaper, and have the BroadphaseTuner benchmark the spatial hash again; then lower `game_speed` towards 1,
+      in proportion to the overload; then lower the stepper's `max_substeps`, so the backlog is
+      dropped instead of piling up. Far over budget, the speed is lowered before any trial, since
+      no setting makes up for that.
+    - Physics with headroom: undo the last two, up to the speed picked with the slider.
+    - Frames over budget: switch to the density heatmap at closer zoom levels; undo it with headroom.
+
+    A condition has to hold for `patience` updates in a row, the budgets have separate HIGH and
+    LOW thresholds, and every change is followed by `cooldown` updates without one, so settings
+    do not oscillate.
+    """
+
+    HIGH = 0.9  # Fraction of a budget above which the load is too high.
+    LOW = 0.6  # Fraction of a budget below which there is headroom.
+    FAR_OVER = 1.5  # Load above which the speed is lowered before trying other settings.
+    MAX_LOD_ZOOM = 1.0
+
+    def __init__(self, scene, target_frame_time=1 / 60, patience=2, cooldown=2, trial_steps=60,
+                 trial_updates=3, retry_after=30, min_gain=0.05):
+        self.scene = scene
+        self.target_frame_time = target_frame_time
+        self.patience = patience
+        self.cooldown = cooldown
+        # A trial lasts trial_steps steps, or trial_updates updates when the physics is that slow.
+        self.trial_steps = trial_steps
+        self.trial_updates = trial_updates
+        self.retry_after = retry_after
+        self.min_gain = min_gain
+        # The settings the scene started with, which headroom restores.
+        self.max_substeps = scene.stepper.max_substeps
+        self.lod_zoom = scene.lod_zoom
+
+        self.updates = 0
+        self.wait = 0
+        self.streaks = {'physics': 0, 'render': 0}
+        self.trial = None
+        self.tried = {}  # Update number of the last trial of each setting.
+        self.last_busy = None
+        self.last_steps = None
+        self.last_change = None
+
+    def update(self):
+        self.updates += 1
+        physics = self.physics_load()
+        render = self.render_load()
+        if self.trial is not None:
+            self.finish_trial()
+            return
+
+        self.count_streak('physics', physics)
+        self.count_streak('render', render)
+        if self.wait:
+            self.wait -= 1
+            return
+        if self.tune_physics(physics) or self.tune_render():
+            self.wait = self.cooldown
+            self.streaks = {'physics': 0, 'render': 0}
+
+    def physics_load(self):
+        """Fraction of real time the physics thread needs to keep up with game_speed."""
+        scene = self.scene
+        totals = scene.timer.totals
+        busy = totals.get('physics', 0.0) + totals.get('viewport', 0.0)
+        steps = scene.stepper.steps
+        last_busy, last_steps = self.last_busy, self.last_steps
+        self.last_busy, self.last_steps = busy, steps
+        if last_busy is None or steps <= last_steps:
+            return None
+        cost = (busy - last_busy) / (steps - last_steps)
+        return cost * scene.game_speed / scene.stepper.dt
+
+    def render_load(self):
+        frame = self.scene.render_timer.report().get('frame')
+        if frame is None or 'p95' not in frame:
+            return None
+        return frame['p95'] / self.target_frame_time
+
+    def count_streak(self, name, load):
+        # Positive streaks count updates over budget, negative ones updates with headroom.
+        streak = self.streaks[name]
+        if load is None or self.LOW <= load <= self.HIGH:
+            self.streaks[name] = 0
+        elif load > self.HIGH:
+            self.streaks[name] = max(streak, 0) + 1
+        else:
+            self.streaks[name] = min(streak, 0) - 1
+
+    def tune_physics(self, load):
+        scene = self.scene
+        stepper = scene.stepper
+        if self.streaks['physics'] >= self.patience:
+            speed = scene.game_speed
+            # Trials are not started while the tuner switches hash sizes, both compare space.step times.
+            tuning = scene.broadphase.active or scene.broadphase.requested
+            if (load < self.FAR_OVER or speed <= 1) and not tuning:
+                if self.due('threads'):
+                    self.start_thread_trial()
+                    return True
+                if self.due('broadphase'):
+                    self.tried['broadphase'] = self.updates
+                    scene.broadphase.start()
+                    return True
+            if speed > 1:
+                return self.change('game_speed', max(1, min(speed - 1, int(speed * self.HIGH / load))))
+            if stepper.max_substeps > 1:
+                return self.change('max_substeps', max(1, stepper.max_substeps // 2))
+
+        elif self.streaks['physics'] <= -self.patience:
+            if stepper.max_substeps < self.max_substeps:
+                return self.change('max_substeps', min(self.max_substeps, stepper.max_substeps * 2))
+            # Only speed up if the higher speed is still expected to fit the budget.
+            speed = scene.game_speed
+            if speed < scene.requested_speed and load * (speed + 1) / speed < self.HIGH:
+                return self.change('game_speed', min(scene.requested_speed, speed + 1))
+        return False
+
+    def due(self, setting):
+        return self.updates - self.tried.get(setting, -self.retry_after) >= self.retry_after
+
+    def tune_render(self):
+        scene = self.scene
+        if self.streaks['render'] >= self.patience and scene.lod_zoom < self.MAX_LOD_ZOOM:
+            return self.change('lod_zoom', min(self.MAX_LOD_ZOOM, scene.lod_zoom * 1.25))
+        if self.streaks['render'] <= -self.patience and scene.lod_zoom > self.lod_zoom:
+            return self.change('lod_zoom', max(self.lod_zoom, scene.lod_zoom / 1.25))
+        return False
+
+    def change(self, setting, value):
+        scene = self.scene
+        if setting == 'max_substeps':
+            scene.stepper.max_substeps = value
+        else:
+            setattr(scene, setting, value)
+        self.last_change = (setting, value)
+        return True
+
+    def start_thread_trial(self):
+        # Switch between one and two space threads; finish_trial keeps whichever steps faster.
+        scene = self.scene
+        old, new = scene.space.threads, 2 if scene.space.threads == 1 else 1
+        baseline = np.median(scene.timer.recent('space.step') or [np.inf])
+        scene.request_space_settings(threads=new)
+        self.trial = {'setting': 'threads', 'old': old, 'new': new, 'baseline': baseline,
+                      'start': scene.stepper.steps, 'started': self.updates}
+
+    def finish_trial(self):
+        scene = self.scene
+        trial = self.trial
+        steps = scene.stepper.steps - trial['start']
+        if steps < self.trial_steps and (self.updates - trial['started'] < self.trial_updates or steps < 8):
+            return
+        # Only the steps run with the new setting, skipping the first ones while it settles.
+        samples = scene.timer.recent('space.step')[-(steps - steps // 4):]
+        cost = np.median(samples) if samples else np.inf
+        if cost < trial['baseline'] * (1 - self.min_gain):
+            self.last_change = (trial['setting'], trial['new'])
+        else:
+            scene.request_space_settings(**{trial['setting']: trial['old']})
+        self.tried[trial['setting']] = self.updates
+        self.trial = None
+        self.wait = self.cooldown
@@ -0,0 +1,93 @@
+import csv
+import json
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class PhaseTimer:
+    """Accumulates wall-clock time spent in named phases of the simulation.
+
+    Besides the running totals, the last `window` samples of every phase are kept for rolling
+    percentiles. Only one thread should time into a PhaseTimer, any thread can read it.
+    """
+
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, window=240):
+        self.window = window
+        self.totals = {}
+        self.counts = {}
+        self.samples = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        # Counts first, a reader that finds a name in totals also finds it in counts.
+        self.counts[name] = self.counts.get(name, 0) + 1
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def last(self, name):
+        """The latest sample of a phase."""
+        return self.samples[name][-1]
+
+    def recent(self, name):
+        """The last samples of a phase, oldest first."""
+        # list() copies a deque without releasing the GIL, so it is safe while the timing thread appends.
+        return list(self.samples.get(name, ()))
+
+    def reset(self):
+        self.totals.clear()
+        self.counts.clear()
+        self.samples.clear()
+
+    def report(self):
+        report = {}
+        for name, total in list(self.totals.items()):
+            count = self.counts[name]
+            recent = np.array(self.recent(name))
+            entry = {'total': total, 'count': count, 'mean': total / count}
+            if len(recent):
+                for q, value in zip(self.PERCENTILES, np.percentile(recent, self.PERCENTILES)):
+                    entry[f'p{q}'] = float(value)
+                entry['max'] = float(recent.max())
+            report[name] = entry
+        return report
+
+
+class MetricsExporter:
+    """Writes PhaseTimer reports to a CSV or JSON-lines file, picked by the file extension.
+
+    JSON lines get one object per `write`, CSV one row per phase and `write`.
+    """
+
+    FIELDS = ('step', 'time', 'phase', 'count', 'mean', 'p50', 'p95', 'p99', 'max')
+
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='')
+        self.csv = None
+        if not path.endswith(('.jsonl', '.json')):
+            self.csv = csv.DictWriter(self.file, self.FIELDS, extrasaction='ignore')
+            self.csv.writeheader()
+
+    def write(self, step, elapsed, report):
+        if self.csv is None:
+            self.file.write(json.dumps({'step': step, 'time': elapsed, 'phases': report}) + '\n')
+            return
+        for name, phase in report.items():
+            self.csv.writerow(dict(phase, step=step, time=elapsed, phase=name))
+
+    def close(self):
+        self.file.close()
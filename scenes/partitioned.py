@@ -0,0 +1,381 @@
+import itertools
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+import pymunk
+
+from particles.molecule_store import MoleculeStore
+from scenes.constants import MOLECULES_LAYER
+from scenes.metrics import PhaseTimer
+from scenes.spawner import lattice_positions, random_attributes
+
+# Columns of the record arrays exchanged between the tiles.
+ID, X, Y, VX, VY, MASS, RADIUS = range(7)
+RECORD_SIZE = 7
+# Columns of the shared-memory render arrays.
+SHARED_COLUMNS = 4  # x, y, radius, mass
+
+
+def empty_records():
+    return np.zeros((0, RECORD_SIZE), dtype=np.float64)
+
+
+def make_space(settings, world_width, world_height):
+    space = pymunk.Space()
+    space.use_spatial_hash(settings['hash_dim'], settings['hash_count'])
+    space.damping = settings['damping']
+    space.sleep_time_threshold = settings['sleep_time_threshold']
+    space.idle_speed_threshold = settings['idle_speed_threshold']
+
+    corners = [(0, 0), (world_width, 0), (world_width, world_height), (0, world_height)]
+    walls = [pymunk.Segment(space.static_body, corners[i], corners[(i + 1) % 4], 5) for i in range(4)]
+    space.add(*walls)
+    return space
+
+
+def tile_worker(bounds, world_size, settings, halo, connection, shared_name, capacity, sweep_interval=60):
+    """Simulates the molecules of one tile in its own process and pymunk.Space.
+
+    The coordinator sends ('spawn', records), ('step', dt, migrants, ghosts), ('gather',),
+    ('records',) and ('stop',). After every step the worker answers with the molecules that left
+    its tile and the ones in its border strips; a gather writes the positions of as many of its
+    molecules as fit to shared memory and answers with the written and the owned count.
+    ('render', name, capacity) switches to a larger shared block and gathers again, and
+    ('records',) answers with the full records of all its molecules.
+
+    Only the strips `halo` wide on both sides of the tile edges are looked up in the space
+    every step. A molecule that jumps over the outer strip in one step is found by the full
+    sweep every `sweep_interval` steps.
+    """
+    left, bottom, right, top = bounds
+    world_width, world_height = world_size
+    space = make_space(settings, world_width, world_height)
+    shared = shared_memory.SharedMemory(name=shared_name)
+    render = np.ndarray((capacity, SHARED_COLUMNS), dtype=np.float32, buffer=shared.buf)
+    query_filter = pymunk.ShapeFilter(mask=MOLECULES_LAYER)
+    owned = {}
+    ghosts = {}
+    steps = 0
+
+    # Emigrants are in the strips just outside the tile, border molecules in the strips just
+    # inside the edges that are shared with another tile.
+    outer = [pymunk.BB(left - halo, bottom - halo, left, top + halo),
+             pymunk.BB(right, bottom - halo, right + halo, top + halo),
+             pymunk.BB(left, bottom - halo, right, bottom),
+             pymunk.BB(left, top, right, top + halo)]
+    inner = []
+    if left > 0:
+        inner.append(pymunk.BB(left, bottom, left + halo, top))
+    if right < world_width:
+        inner.append(pymunk.BB(right - halo, bottom, right, top))
+    if bottom > 0:
+        inner.append(pymunk.BB(left, bottom, right, bottom + halo))
+    if top < world_height:
+        inner.append(pymunk.BB(left, top - halo, right, top))
+
+    def add_owned(records):
+        for record in records:
+            molecule_id = int(record[ID])
+            if molecule_id in ghosts:
+                space.remove(*ghosts.pop(molecule_id))
+            body, shape = MoleculeStore.create_body(record[RADIUS], record[MASS], (record[X], record[Y]))
+            body.velocity = (record[VX], record[VY])
+            body.molecule_id = molecule_id
+            space.add(body, shape)
+            owned[molecule_id] = (body, shape, record[MASS], record[RADIUS])
+
+    def sync_ghosts(records):
+        # Ghosts mirror the neighbours' border molecules as dynamic bodies with their real mass, so
+        # that a collision across the edge is resolved the same way on both sides. The state of a
+        # ghost after the step is thrown away: the next step overwrites it from the owner's records.
+        incoming = set()
+        for record in records:
+            molecule_id = int(record[ID])
+            if molecule_id in owned:
+                continue
+            incoming.add(molecule_id)
+            ghost = ghosts.get(molecule_id)
+            if ghost is None:
+                ghost = MoleculeStore.create_body(record[RADIUS], record[MASS], (record[X], record[Y]))
+                space.add(*ghost)
+                ghosts[molecule_id] = ghost
+            else:
+                ghost[0].position = (record[X], record[Y])
+                ghost[0].angular_velocity = 0
+            ghost[0].velocity = (record[VX], record[VY])
+
+        for molecule_id in [molecule_id for molecule_id in ghosts if molecule_id not in incoming]:
+            space.remove(*ghosts.pop(molecule_id))
+
+    def owned_in(boxes):
+        # Ids of the owned molecules whose shapes overlap any of the boxes; ghosts have no id.
+        found = set()
+        for box in boxes:
+            for shape in space.bb_query(box, query_filter):
+                molecule_id = getattr(shape.body, 'molecule_id', None)
+                if molecule_id is not None:
+                    found.add(molecule_id)
+        return sorted(found)
+
+    def records_of(ids):
+        rows = [(molecule_id, *body.position, *body.velocity, mass, radius)
+                for molecule_id in ids for body, _, mass, radius in (owned[molecule_id],)]
+        return np.array(rows, dtype=np.float64).reshape(-1, RECORD_SIZE)
+
+    def outside(records):
+        x, y = records[:, X], records[:, Y]
+        return (x < left) | (x >= right) | (y < bottom) | (y >= top)
+
+    def write_render():
+        entries = list(itertools.islice(owned.values(), capacity))
+        count = len(entries)
+        positions = itertools.chain.from_iterable([body.position for body, _, _, _ in entries])
+        render[:count, 0:2] = np.fromiter(positions, dtype=np.float64, count=2 * count).reshape(-1, 2)
+        render[:count, 2] = [radius for _, _, _, radius in entries]
+        render[:count, 3] = [mass for _, _, mass, _ in entries]
+        return count, len(owned)
+
+    def attach(name, size):
+        nonlocal shared, render, capacity
+        del render
+        shared.close()
+        shared = shared_memory.SharedMemory(name=name)
+        capacity = size
+        render = np.ndarray((capacity, SHARED_COLUMNS), dtype=np.float32, buffer=shared.buf)
+
+    try:
+        while True:
+            message = connection.recv()
+            if message[0] == 'stop':
+                break
+            if message[0] == 'spawn':
+                add_owned(message[1])
+                continue
+            if message[0] == 'gather':
+                connection.send(write_render())
+                continue
+            if message[0] == 'render':
+                attach(message[1], message[2])
+                connection.send(write_render())
+                continue
+            if message[0] == 'records':
+                connection.send(records_of(list(owned)))
+                continue
+
+            _, dt, migrants, ghost_records = message
+            add_owned(migrants)
+            sync_ghosts(ghost_records)
+            space.step(dt)
+            steps += 1
+
+            candidates = list(owned) if steps % sweep_interval == 0 else owned_in(outer)
+            records = records_of(candidates)
+            emigrants = records[outside(records)]
+            for molecule_id in emigrants[:, ID].astype(np.int64).tolist():
+                body, shape, _, _ = owned.pop(molecule_id)
+                space.remove(body, shape)
+
+            connection.send((emigrants, records_of(owned_in(inner))))
+    finally:
+        del render
+        shared.close()
+        connection.close()
+
+
+class PartitionedSimulation:
+    """Runs the molecule world split into tiles, one worker process and pymunk.Space per tile.
+
+    Molecules that cross a tile boundary are handed off to the tile that now owns them, and every
+    tile sees its neighbours' molecules within `halo` pixels of the shared edge as ghosts.
+    The coordinator steps all tiles in lock-step and routes migrants and ghosts between them.
+    Positions are read back from one shared-memory block per tile, without pickling, when
+    `gather` asks for them.
+
+    Waves and the other single-space subsystems of GameScene do not run here, and nothing renders
+    it yet; this is the engine for scaling plain molecule counts across cores, run by
+    `benchmark.py --tiles`. Use it as a context manager, or call `close`, so that the shared
+    blocks are unlinked however the run ends.
+    """
+
+    def __init__(self, world_width=5000, world_height=5000, tiles=(2, 2), halo=20, damping=0.95):
+        self.world_width = world_width
+        self.world_height = world_height
+        self.tiles_x, self.tiles_y = tiles
+        self.tile_width = world_width / self.tiles_x
+        self.tile_height = world_height / self.tiles_y
+        self.halo = halo
+        self.damping = damping
+        self.timer = PhaseTimer()
+        self.molecules_count = 0
+        self.workers = []
+        self.connections = []
+        self.shared = []
+        self.render_arrays = []
+        self.counts = []
+        self.migrants = []
+        self.ghosts = []
+
+    def space_settings(self, capacity):
+        return {
+            'hash_dim': 10,
+            'hash_count': max(10000, 10 * capacity),
+            'damping': self.damping,
+            'sleep_time_threshold': 0.1,
+            'idle_speed_threshold': 0.01,
+        }
+
+    def tile_bounds(self, tile):
+        column, row = tile % self.tiles_x, tile // self.tiles_x
+        return (column * self.tile_width, row * self.tile_height,
+                (column + 1) * self.tile_width, (row + 1) * self.tile_height)
+
+    def tile_of(self, positions):
+        column = np.clip((positions[:, 0] // self.tile_width).astype(np.intp), 0, self.tiles_x - 1)
+        row = np.clip((positions[:, 1] // self.tile_height).astype(np.intp), 0, self.tiles_y - 1)
+        return row * self.tiles_x + column
+
+    def populate(self, molecules_count, seed=None, padding=100):
+        """Fill the world with the same lattice as GameScene.init_molecules and start the workers."""
+        rng = np.random.default_rng(seed)
+        positions = lattice_positions(self.world_width, self.world_height, molecules_count, padding)
+        count = len(positions)
+        records = np.zeros((count, RECORD_SIZE), dtype=np.float64)
+        records[:, ID] = np.arange(count)
+        records[:, X:Y + 1] = positions
+        records[:, MASS], records[:, RADIUS], records[:, VX:VY + 1] = random_attributes(rng, count)
+        self.molecules_count = count
+
+        self.start(records)
+
+    def start(self, records):
+        # Room for twice the even share per tile; gather grows the block of a tile that outgrows it.
+        capacity = max(1024, 2 * len(records) // (self.tiles_x * self.tiles_y))
+
+        try:
+            self.start_workers(records, capacity)
+        except BaseException:
+            self.close()
+            raise
+
+    def start_workers(self, records, capacity):
+        tiles = self.tiles_x * self.tiles_y
+        owners = self.tile_of(records[:, X:Y + 1])
+        settings = self.space_settings(capacity)
+        context = multiprocessing.get_context('spawn')
+        for tile in range(tiles):
+            shared = shared_memory.SharedMemory(create=True, size=capacity * SHARED_COLUMNS * 4)
+            self.shared.append(shared)
+            parent, child = context.Pipe()
+            worker = context.Process(
+                target=tile_worker,
+                args=(self.tile_bounds(tile), (self.world_width, self.world_height), settings, self.halo,
+                      child, shared.name, capacity),
+                daemon=True,
+            )
+            worker.start()
+            child.close()
+            self.workers.append(worker)
+            self.connections.append(parent)
+            parent.send(('spawn', records[owners == tile]))
+
+            self.render_arrays.append(np.ndarray((capacity, SHARED_COLUMNS), dtype=np.float32, buffer=shared.buf))
+            self.counts.append(0)
+            self.migrants.append(empty_records())
+            self.ghosts.append(empty_records())
+
+    def step(self, dt):
+        with self.timer.phase('step'):
+            for tile, connection in enumerate(self.connections):
+                connection.send(('step', dt, self.migrants[tile], self.ghosts[tile]))
+            replies = [connection.recv() for connection in self.connections]
+
+        with self.timer.phase('exchange'):
+            self.route(replies)
+
+    def route(self, replies):
+        tiles = len(self.connections)
+        emigrants = np.concatenate([reply[0] for reply in replies])
+        owners = self.tile_of(emigrants[:, X:Y + 1])
+        self.migrants = [emigrants[owners == tile] for tile in range(tiles)]
+
+        ghosts = [[] for _ in range(tiles)]
+        for source, reply in enumerate(replies):
+            border = reply[1]
+            if len(border) == 0:
+                continue
+            x, y = border[:, X], border[:, Y]
+            for tile in range(tiles):
+                if tile == source:
+                    continue
+                left, bottom, right, top = self.tile_bounds(tile)
+                inside = ((x >= left - self.halo) & (x < right + self.halo)
+                          & (y >= bottom - self.halo) & (y < top + self.halo))
+                if inside.any():
+                    ghosts[tile].append(border[inside])
+        self.ghosts = [np.concatenate(parts) if parts else empty_records() for parts in ghosts]
+
+    def gather(self):
+        """Positions, radii and masses of all molecules, read from shared memory.
+
+        Molecules handed off in the last step are not in any tile yet and are taken from the
+        pending migrants instead.
+        """
+        with self.timer.phase('gather'):
+            for connection in self.connections:
+                connection.send(('gather',))
+            replies = [connection.recv() for connection in self.connections]
+            for tile, (written, count) in enumerate(replies):
+                if written < count:
+                    replies[tile] = self.grow(tile, 2 * count)
+            self.counts = [written for written, _ in replies]
+            parts = [array[:count] for array, count in zip(self.render_arrays, self.counts)]
+            parts.extend(migrants[:, [X, Y, RADIUS, MASS]] for migrants in self.migrants if len(migrants))
+            data = np.concatenate(parts)
+        return data[:, 0:2], data[:, 2], data[:, 3]
+
+    def grow(self, tile, capacity):
+        """Move a tile to a new shared block of `capacity` molecules and gather it again."""
+        shared = shared_memory.SharedMemory(create=True, size=capacity * SHARED_COLUMNS * 4)
+        previous, self.shared[tile] = self.shared[tile], shared
+        self.render_arrays[tile] = np.ndarray((capacity, SHARED_COLUMNS), dtype=np.float32, buffer=shared.buf)
+        previous.close()
+        previous.unlink()
+
+        connection = self.connections[tile]
+        connection.send(('render', shared.name, capacity))
+        return connection.recv()
+
+    def records(self):
+        """Full records (id, position, velocity, mass, radius) of all molecules, pickled from the tiles."""
+        for connection in self.connections:
+            connection.send(('records',))
+        parts = [connection.recv() for connection in self.connections]
+        parts.extend(self.migrants)
+        return np.concatenate(parts)
+
+    def close(self):
+        """Stop the workers and unlink the shared blocks, also after a worker died."""
+        for connection in self.connections:
+            try:
+                connection.send(('stop',))
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        for connection in self.connections:
+            connection.close()
+        self.render_arrays.clear()
+        for shared in self.shared:
+            shared.close()
+            shared.unlink()
+        self.workers, self.connections, self.shared = [], [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,163 @@
+import numpy as np
+import pymunk
+
+from scenes.constants import MOLECULES_LAYER
+
+
+class RegionMap:
+    """Freezes quiet regions of the world, so that their molecules cost no Python work.
+
+    The world is split into square regions of `region_size`. Every `check_interval` steps one
+    region is checked, round-robin: if no wave front is near it and all molecules with their
+    centre in it are slower than `quiet_speed`, their bodies are put to sleep and the molecules
+    flagged in `MoleculeStore.frozen`. Sleeping bodies are skipped by `space.step`, and the
+    store serves the positions and velocities of frozen molecules from its arrays, so the
+    viewport, energy and merge passes do not read them from pymunk either. The visibility cells
+    of a frozen region are not re-queried.
+
+    A frozen region is woken in bulk when a wave front comes within `wave_margin` of it. Other
+    disturbances wake single bodies in pymunk: an awake molecule that touches a sleeping one
+    wakes it. Such a contact can only start at the edge of a region, so `verify` only looks at
+    the frozen molecules within two radii of the edge, `verify_budget` of them per step, and
+    wakes the whole region as soon as one of them is awake.
+    """
+
+    def __init__(self, scene, region_size=512, quiet_speed=0.5, wave_margin=64, check_interval=4,
+                 verify_budget=100):
+        self.scene = scene
+        self.space = scene.space
+        self.molecules = scene.molecules
+        self.region_size = region_size
+        self.quiet_speed = quiet_speed
+        self.wave_margin = wave_margin
+        self.check_interval = check_interval
+        self.verify_budget = verify_budget
+        self.enabled = True
+        self.query_filter = pymunk.ShapeFilter(mask=MOLECULES_LAYER)
+
+        self.columns = int(scene.world_width // region_size) + 1
+        self.rows = int(scene.world_height // region_size) + 1
+        count = self.columns * self.rows
+        column, row = np.arange(count) % self.columns, np.arange(count) // self.columns
+        # Region boxes as left, bottom, right, top.
+        self.boxes = np.stack([column * region_size, row * region_size,
+                               (column + 1) * region_size, (row + 1) * region_size], axis=1).astype(np.float64)
+        self.frozen = np.zeros(count, dtype=bool)
+        self.members = [None] * count  # Ids of the molecules frozen in each region.
+        self.borders = [None] * count  # The ones near the edge of the region.
+
+        self.steps = 0
+        self.next_check = 0
+        self.next_verify = 0
+        self.woken = 0  # Regions woken so far.
+
+    def __len__(self):
+        return len(self.frozen)
+
+    def frozen_count(self):
+        """Number of frozen regions and of the molecules in them; safe to call from another thread."""
+        members = list(self.members)
+        return int(self.frozen.sum()), sum(len(ids) for ids in members if ids is not None)
+
+    def step(self):
+        """Called on the physics thread after space.step, before the waves are swept."""
+        if not self.enabled:
+            return
+        self.steps += 1
+        near = self.near_waves()
+        for region in np.flatnonzero(self.frozen & near).tolist():
+            self.wake(region)
+        self.verify()
+        if self.steps % self.check_interval == 0:
+            region = self.next_check
+            self.next_check = (region + 1) % len(self)
+            if not self.frozen[region] and not near[region]:
+                self.try_freeze(region)
+
+    def near_waves(self):
+        """Which regions a wave front is about to reach, as a bool array."""
+        waves = self.scene.waves_active
+        if not waves:
+            return np.zeros(len(self), dtype=bool)
+        # One row per wave: its centre and the band the WaveEngine sweeps next, widened by the margin.
+        bands = np.array([(*wave.position, min(wave.swept_radius, wave.radius) - self.wave_margin,
+                           wave.radius + self.wave_margin) for wave in waves])
+        cx, cy, inner, outer = (bands[:, column, None] for column in range(4))
+        left, bottom, right, top = self.boxes.T
+        # Nearest and farthest distance from every wave centre to every region.
+        near_x = np.maximum(np.maximum(left - cx, cx - right), 0)
+        near_y = np.maximum(np.maximum(bottom - cy, cy - top), 0)
+        far_x = np.maximum(np.abs(left - cx), np.abs(right - cx))
+        far_y = np.maximum(np.abs(bottom - cy), np.abs(top - cy))
+        return ((np.hypot(near_x, near_y) <= outer) & (np.hypot(far_x, far_y) >= inner)).any(axis=0)
+
+    def inside(self, region, positions):
+        left, bottom, right, top = self.boxes[region]
+        return ((positions[:, 0] >= left) & (positions[:, 0] < right)
+                & (positions[:, 1] >= bottom) & (positions[:, 1] < top))
+
+    def try_freeze(self, region):
+        # The candidates come from the space, not from the stored positions: those are also
+        # refreshed by the energy statistics and checkpoints, at times a replay does not see.
+        molecules = self.molecules
+        ids = [shape.body.molecule_id for shape in self.space.bb_query(pymunk.BB(*self.boxes[region]), self.query_filter)
+               if hasattr(shape.body, 'molecule_id')]
+        if not ids:
+            return False
+        ids = np.sort(np.array(ids, dtype=np.intp))
+        molecules.sync(ids)
+        ids = ids[self.inside(region, molecules.positions[ids])]
+        velocities = molecules.velocities[ids]
+        if len(ids) == 0 or (np.hypot(velocities[:, 0], velocities[:, 1]) >= self.quiet_speed).any():
+            return False
+
+        # The arrays take over from the bodies until the region is woken.
+        bodies = molecules.bodies
+        for molecule_id in ids.tolist():
+            body = bodies[molecule_id]
+            if not body.is_sleeping:
+                body.sleep()
+        molecules.frozen[ids] = True
+        self.members[region] = ids
+        reach = 2 * float(molecules.radii[:molecules.size].max()) + 1
+        left, bottom, right, top = self.boxes[region]
+        positions = molecules.positions[ids]
+        edge = np.minimum(np.minimum(positions[:, 0] - left, right - positions[:, 0]),
+                          np.minimum(positions[:, 1] - bottom, top - positions[:, 1]))
+        self.borders[region] = ids[edge < reach]
+        self.frozen[region] = True
+        self.scene.visibility.pin(*self.boxes[region])
+        return True
+
+    def wake(self, region):
+        molecules = self.molecules
+        ids = self.members[region]
+        bodies = molecules.bodies
+        for molecule_id in ids.tolist():
+            bodies[molecule_id].activate()
+        molecules.frozen[ids] = False
+        self.members[region] = None
+        self.borders[region] = None
+        self.frozen[region] = False
+        self.woken += 1
+        self.scene.visibility.unpin(*self.boxes[region])
+
+    def verify(self):
+        """Check the edges of frozen regions, round-robin, for bodies pymunk has woken up."""
+        frozen = np.flatnonzero(self.frozen)
+        if len(frozen) == 0:
+            return
+        bodies = self.molecules.bodies
+        start = np.searchsorted(frozen, self.next_verify) % len(frozen)
+        checked = 0
+        for region in np.roll(frozen, -start).tolist():
+            if checked >= self.verify_budget:
+                self.next_verify = region
+                return
+            border = self.borders[region]
+            checked += len(border)
+            for molecule_id in border.tolist():
+                if not bodies[molecule_id].is_sleeping:
+                    self.wake(region)
+                    break
+        self.next_verify = 0
@@ -1,42 +1,151 @@
+import numpy as np
 import pygame
-import pymunk
 
 
 class Renderer:
-    def __init__(self, game_scene):
+    # Molecule drawing backends: 'sprites' blits one cached sprite per molecule in a single
+    # Surface.blits call, 'splat' stamps the molecules into the pixel array with NumPy, and 'auto'
+    # switches to 'splat' once more than SPLAT_THRESHOLD molecules are visible.
+    RENDER_MODES = ('auto', 'sprites', 'splat')
+    SPLAT_THRESHOLD = 20000
+
+    def __init__(self, game_scene, render_mode='auto'):
         self.game_scene = game_scene
-        self.view_port = None
+        # Camera position (world pixels) and zoom used for the current frame.
+        self.camera = (0, 0)
+        self.zoom = 1.0
+        self.render_mode = render_mode
+        # Static geometry in world coordinates, drawn with the camera offset every frame.
+        self.static_lines = None
+        # Pre-rasterized circles, keyed by the packed (radius, color) bucket.
+        self.sprites = {}
+        # Pixel offsets covering a disc, per integer radius, for the splat path.
+        self.disc_offsets = {}
+        # The last heatmap scaled to screen size, reused while neither it nor the zoom changes.
+        self.scaled_heatmap = None
+        self.scaled_heatmap_key = None
+        # Off, frames show the latest step as is, so that headless captures do not depend on timing.
+        self.interpolate = True
 
     def render(self):
-        self.view_port = pygame.Rect(self.game_scene.camera_x, self.game_scene.camera_y, self.game_scene.screen.get_width(), self.game_scene.screen.get_height())
-        self.game_scene.world.fill((0, 0, 0))
-        self.game_scene.molecule_layer.fill((0, 0, 0, 0))
-
-        visible_layer = pygame.Surface((self.game_scene.screen.get_width(), self.game_scene.screen.get_height()), pygame.SRCALPHA)
+        # Everything is drawn straight into the screen, in camera space. The world is clipped to
+        # the part of the screen left of the panel, which redraws its own area when it changed.
+        screen = self.game_scene.screen
+        timer = self.game_scene.render_timer
+        self.camera = (self.game_scene.camera_x, self.game_scene.camera_y)
+        self.zoom = self.game_scene.zoom
+        panel = self.game_scene.panel
+        world = screen.get_rect()
+        if panel is not None:
+            world.width = panel.rect.left
+        screen.set_clip(world)
+        screen.fill((0, 0, 0), world)
 
-        self.render_molecules(visible_layer)
-        # self.render_waves(visible_layer)
-        self.game_scene.world.blit(visible_layer, self.view_port)
+        with timer.phase('render.molecules'):
+            self.render_molecules(screen)
+        # self.render_waves(screen)
+        with timer.phase('render.walls'):
+            self.render_walls(screen)
+        screen.set_clip(None)
+        if panel is not None:
+            with timer.phase('render.panel'):
+                panel.render(screen)
 
-        self.render_walls(self.game_scene.world)
-        self.render_camera_view()
-        self.game_scene.panel.render(self.game_scene.screen)
+        # The composed frame is copied out before the flip, the encoding happens elsewhere.
+        if self.game_scene.capture is not None:
+            with timer.phase('render.capture'):
+                self.game_scene.capture.capture(screen)
 
-        pygame.display.flip()
+        if not self.game_scene.headless:
+            with timer.phase('render.flip'):
+                pygame.display.flip()
 
     def render_molecules(self, layer):
-        rect_left, rect_top, rect_width, rect_height = self.view_port
-        molecules_in_viewport = self.game_scene.visible_molecules
-        for molecule in molecules_in_viewport:
-            pos_x, pos_y = molecule.body.position
-            screen_pos_x, screen_pos_y = (pos_x - rect_left), (pos_y - rect_top)
-            pygame.draw.circle(layer, molecule.color, (screen_pos_x, screen_pos_y), molecule.radius)
+        snapshot = self.game_scene.snapshots.acquire()
+        if snapshot is None:
+            return
+        if snapshot.heatmap is not None:
+            self.render_heatmap(layer, snapshot)
+            return
+
+        # Interpolate between the last two physics steps.
+        positions = (snapshot.interpolated_positions(None if self.interpolate else 1.0) - self.camera) * self.zoom
+        radii = np.maximum(np.rint(snapshot.radii[:snapshot.count] * self.zoom), 1).astype(np.intp)
+        colors = snapshot.colors[:snapshot.count]
+
+        mode = self.render_mode
+        if mode == 'auto':
+            mode = 'splat' if snapshot.count > self.SPLAT_THRESHOLD else 'sprites'
+        if mode == 'splat':
+            self.splat_molecules(layer, positions, radii, colors)
+        else:
+            self.blit_molecules(layer, positions, radii, colors)
+
+    def render_heatmap(self, layer, snapshot):
+        # One heatmap pixel per cell, scaled up to the zoomed size of the world.
+        key = (id(snapshot.heatmap), self.zoom)
+        if key != self.scaled_heatmap_key:
+            columns, rows = snapshot.heatmap.shape[:2]
+            size = (max(1, round(columns * snapshot.heatmap_cell * self.zoom)),
+                    max(1, round(rows * snapshot.heatmap_cell * self.zoom)))
+            self.scaled_heatmap = pygame.transform.smoothscale(pygame.surfarray.make_surface(snapshot.heatmap), size)
+            self.scaled_heatmap_key = key
+        layer.blit(self.scaled_heatmap, (-self.camera[0] * self.zoom, -self.camera[1] * self.zoom))
+
+    def sprite(self, radius, color):
+        sprite = pygame.Surface((2 * radius + 1, 2 * radius + 1), pygame.SRCALPHA)
+        pygame.draw.circle(sprite, color, (radius, radius), radius)
+        return sprite
+
+    def blit_molecules(self, layer, positions, radii, colors):
+        # Bucket the molecules by (radius, color) and look up one sprite per bucket.
+        keys = (radii << 24) | (colors[:, 0].astype(np.intp) << 16) | (colors[:, 1].astype(np.intp) << 8) | colors[:, 2]
+        buckets, inverse = np.unique(keys, return_inverse=True)
+
+        sprites = np.empty(len(buckets), dtype=object)
+        for bucket, key in enumerate(buckets.tolist()):
+            sprite = self.sprites.get(key)
+            if sprite is None:
+                radius, color = key >> 24, ((key >> 16) & 255, (key >> 8) & 255, key & 255)
+                sprite = self.sprites[key] = self.sprite(radius, color)
+            sprites[bucket] = sprite
+
+        # Sprites are drawn from their top left corner.
+        corners = (positions - radii[:, None]).astype(np.intp).tolist()
+        layer.blits(zip(sprites[inverse.ravel()].tolist(), corners), doreturn=False)
+
+    def splat_molecules(self, layer, positions, radii, colors):
+        # The pixel array ignores the clip rectangle, it is applied here.
+        clip = layer.get_clip()
+        centers = positions.astype(np.intp)
+        pixels = pygame.surfarray.pixels3d(layer)
+        alpha = pygame.surfarray.pixels_alpha(layer) if layer.get_flags() & pygame.SRCALPHA else None
+        try:
+            for radius in np.unique(radii).tolist():
+                offsets = self.disc_offsets.get(radius)
+                if offsets is None:
+                    dx, dy = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+                    inside = dx * dx + dy * dy <= radius * radius
+                    offsets = self.disc_offsets[radius] = (dx[inside], dy[inside])
+
+                group = radii == radius
+                xs = (centers[group, 0, None] + offsets[0]).ravel()
+                ys = (centers[group, 1, None] + offsets[1]).ravel()
+                on_screen = (xs >= clip.left) & (xs < clip.right) & (ys >= clip.top) & (ys < clip.bottom)
+                xs, ys = xs[on_screen], ys[on_screen]
+                pixels[xs, ys] = np.repeat(colors[group], len(offsets[0]), axis=0)[on_screen]
+                if alpha is not None:
+                    alpha[xs, ys] = 255
+        finally:
+            # The pixel arrays lock the surface until they are released.
+            del pixels, alpha
 
     def render_walls(self, layer):
-        for wall in self.game_scene.walls:
-            p1, p2 = wall.a, wall.b
-            pygame.draw.line(layer, wall.color, p1, p2, 5)
+        if self.static_lines is None:
+            self.static_lines = [(wall.color, tuple(wall.a), tuple(wall.b)) for wall in self.game_scene.walls]
 
-    def render_camera_view(self):
-        self.game_scene.screen.blit(self.game_scene.world.subsurface(self.view_port), (0, 0))
+        (offset_x, offset_y), zoom = self.camera, self.zoom
+        for color, (x1, y1), (x2, y2) in self.static_lines:
+            pygame.draw.line(layer, color, ((x1 - offset_x) * zoom, (y1 - offset_y) * zoom),
+                             ((x2 - offset_x) * zoom, (y2 - offset_y) * zoom), max(1, round(5 * zoom)))
 
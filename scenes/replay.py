@@ -0,0 +1,210 @@
+import json
+import struct
+import time
+
+import numpy as np
+
+from particles.wave import Wave
+from scenes import checkpoint
+from scenes.headless import HeadlessRunner
+
+# File layout: MAGIC, a little-endian uint32 header length, the JSON header, then a stream of
+# records. Every record starts with its kind and the step it applies to (packed as RECORD),
+# followed by the payload of that kind. Only changes are written, so a quiet run costs nothing
+# per step beyond the waves it spawns.
+MAGIC = b'HLREPL01'
+VERSION = 1
+RECORD = struct.Struct('<BI')
+DT, SPEED, CAMERA, WAVE, KEYFRAME, END, SPACE, WAVE_BUDGET = range(8)
+PAYLOADS = {
+    DT: struct.Struct('<d'),
+    SPEED: struct.Struct('<d'),
+    CAMERA: struct.Struct('<ddd'),  # camera_x, camera_y, zoom
+    WAVE: struct.Struct('<dddddd'),  # radius, impulse_strength, position, velocity
+    KEYFRAME: struct.Struct('<'),
+    END: struct.Struct('<'),
+    SPACE: struct.Struct('<ddd'),  # threads, hash_dim, hash_count
+    WAVE_BUDGET: struct.Struct('<I'),  # cells the wave engine may sweep per step
+}
+
+
+def keyframe_path(path, step):
+    return f"{path}.{step}.hlc"
+
+
+class Recorder:
+    """Streams the inputs of a GameScene run to a replay log.
+
+    The scene calls `step` before every physics step and `wave` for every wave it spawns. Every
+    `keyframe_interval` steps the full state is written next to the log as a checkpoint, which
+    the replay compares against to measure how far it drifted.
+
+    Together with the seed (or the checkpoint the run started from), the log is enough to re-run
+    the same workload. pymunk's threaded solver may resolve contacts in a different order on
+    multi-core machines, so the keyframes are what tells whether a replay is exact.
+    """
+
+    def __init__(self, path, scene, keyframe_interval=600):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self.last = {}
+        self.last_keyframe = None
+        self.file = open(path, 'wb')
+        header = {
+            'version': VERSION,
+            'seed': scene.seed,
+            'molecules': scene.molecules_requested,
+            'checkpoint': scene.checkpoint_path,
+            'world': [scene.world_width, scene.world_height],
+            'start_step': scene.stepper.steps,
+            'keyframe_interval': keyframe_interval,
+            'space': [scene.space.threads, scene.hash_dim, scene.hash_count],
+            # Waves come from the log, only the parameters that change the physics are needed.
+            'parameters': {'damping': scene.damping, 'max_impulse': scene.max_impulse, 'field': scene.field_kind},
+        }
+        encoded = json.dumps(header).encode('utf-8')
+        self.file.write(MAGIC)
+        self.file.write(struct.pack('<I', len(encoded)))
+        self.file.write(encoded)
+
+    def write(self, kind, step, *values):
+        self.file.write(RECORD.pack(kind, step))
+        self.file.write(PAYLOADS[kind].pack(*values))
+
+    def write_changed(self, kind, step, *values):
+        if self.last.get(kind) != values:
+            self.last[kind] = values
+            self.write(kind, step, *values)
+
+    def step(self, scene):
+        step = scene.stepper.steps
+        self.write_changed(DT, step, scene.stepper.dt)
+        self.write_changed(SPEED, step, scene.game_speed)
+        self.write_changed(CAMERA, step, scene.camera_x, scene.camera_y, scene.zoom)
+        self.write_changed(WAVE_BUDGET, step, scene.wave_engine.cell_budget)
+
+        if self.last_keyframe is None or step - self.last_keyframe >= self.keyframe_interval:
+            self.last_keyframe = step
+            checkpoint.save(scene, keyframe_path(self.path, step))
+            self.write(KEYFRAME, step)
+            self.file.flush()
+
+    def space_settings(self, scene):
+        self.write(SPACE, scene.stepper.steps, scene.space.threads, scene.hash_dim, scene.hash_count)
+
+    def wave(self, step, wave):
+        self.write(WAVE, step, wave.radius, wave.impulse_strength, *wave.position, *wave.velocity)
+
+    def close(self, scene):
+        self.write(END, scene.stepper.steps)
+        self.file.close()
+
+
+def read(path):
+    """The header dict of a replay log and a list of its (kind, step, values) records."""
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a HyperLife replay log")
+        (length,) = struct.unpack('<I', file.read(4))
+        header = json.loads(file.read(length).decode('utf-8'))
+        if header.get('version') != VERSION:
+            raise ValueError(f"{path} has replay version {header.get('version')}, expected {VERSION}")
+        data = file.read()
+
+    records = []
+    offset = 0
+    # A log cut short by a crash ends in a partial record, which is ignored.
+    while offset + RECORD.size <= len(data):
+        kind, step = RECORD.unpack_from(data, offset)
+        payload = PAYLOADS[kind]
+        if offset + RECORD.size + payload.size > len(data):
+            break
+        records.append((kind, step, payload.unpack_from(data, offset + RECORD.size)))
+        offset += RECORD.size + payload.size
+    return header, records
+
+
+class Replayer:
+    """Re-runs a replay log headless, as fast as possible.
+
+    Waves are spawned from the log rather than scheduled, and at every keyframe the replayed
+    positions are compared with the recorded ones.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header, self.records = read(path)
+        self.runner = HeadlessRunner(molecules_count=self.header['molecules'], seed=self.header['seed'],
+                                     wave_interval=0, checkpoint_path=self.header['checkpoint'],
+                                     **self.header.get('parameters', {}))
+        self.scene = self.runner.scene
+        # Space settings and the wave budget come from the log, they are not tuned again.
+        self.scene.broadphase.enabled = False
+        self.scene.wave_engine.time_budget = None
+        threads, hash_dim, hash_count = self.header['space']
+        self.scene.apply_space_settings(threads, hash_dim, hash_count)
+        if self.scene.stepper.steps != self.header['start_step']:
+            raise ValueError(f"{path} starts at step {self.header['start_step']}, "
+                             f"the world was restored at step {self.scene.stepper.steps}")
+        # Without an END record, the log runs up to its last record.
+        self.end_step = self.records[-1][1] if self.records else self.header['start_step']
+
+    def apply(self, kind, step, values):
+        scene = self.scene
+        if kind == DT:
+            scene.stepper.dt = self.runner.dt = values[0]
+        elif kind == SPEED:
+            scene.game_speed = values[0]
+        elif kind == CAMERA:
+            scene.camera_x, scene.camera_y, scene.zoom = values
+        elif kind == WAVE:
+            radius, impulse_strength, x, y, vx, vy = values
+            scene.wave_engine.add(Wave(radius, impulse_strength, (vx, vy), (x, y)))
+        elif kind == SPACE:
+            threads, hash_dim, hash_count = values
+            scene.apply_space_settings(int(threads), hash_dim, int(hash_count))
+        elif kind == WAVE_BUDGET:
+            scene.wave_engine.cell_budget = values[0]
+        elif kind == KEYFRAME:
+            return self.compare(step)
+
+    def compare(self, step):
+        """The largest distance between the replayed and the recorded molecule positions."""
+        try:
+            _, arrays = checkpoint.read(keyframe_path(self.path, step))
+        except FileNotFoundError:
+            return None
+        molecules = self.scene.molecules
+        # Do what the recorder did at this step, syncing the store is part of saving a checkpoint.
+        molecules.sync()
+        ids = np.asarray(arrays['ids'])
+        if len(ids) != len(molecules) or not molecules.alive[ids].all():
+            return float('inf')
+        return float(np.abs(molecules.positions[ids] - arrays['positions']).max(initial=0.0))
+
+    def run(self):
+        self.scene.timer.reset()
+        drift = {}
+        index = 0
+        start = time.perf_counter()
+        for step in range(self.header['start_step'], self.end_step + 1):
+            while index < len(self.records) and self.records[index][1] == step:
+                kind, _, values = self.records[index]
+                error = self.apply(kind, step, values)
+                if kind == KEYFRAME:
+                    drift[step] = error
+                index += 1
+            if step < self.end_step:
+                self.runner.step()
+        elapsed = time.perf_counter() - start
+
+        steps = self.end_step - self.header['start_step']
+        return {
+            'molecules': len(self.scene.molecules),
+            'steps': steps,
+            'elapsed': elapsed,
+            'steps_per_sec': steps / elapsed if elapsed > 0 else 0.0,
+            'init_time': self.runner.init_time,
+            'phases': self.scene.timer.report(),
+            'drift': drift,
+        }
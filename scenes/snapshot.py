@@ -0,0 +1,81 @@
+import time
+
+import numpy as np
+
+
+class Snapshot:
+    """Immutable-once-published copy of what the renderer needs for one physics tick.
+
+    Holds the visible molecule ids with their positions before and after the last step, their
+    radii and colors, and the stepper timing needed to interpolate between the two positions.
+    The arrays are reused between publications and only grow, use `count` to slice them.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.ids = np.zeros(0, dtype=np.intp)
+        self.previous = np.zeros((0, 2), dtype=np.float64)
+        self.current = np.zeros((0, 2), dtype=np.float64)
+        self.radii = np.zeros(0, dtype=np.float32)
+        self.colors = np.zeros((0, 3), dtype=np.uint8)
+        self.camera = (0, 0)
+        # When zoomed out: a (columns, rows, 3) density image with one pixel per heatmap_cell world pixels.
+        self.heatmap = None
+        self.heatmap_cell = 1
+        self.published_at = 0.0
+        self.accumulator = 0.0
+        self.dt = 1.0
+        self.game_speed = 1
+
+    def reserve(self, count):
+        if count > len(self.ids):
+            capacity = max(count, 2 * len(self.ids))
+            self.ids = np.zeros(capacity, dtype=np.intp)
+            self.previous = np.zeros((capacity, 2), dtype=np.float64)
+            self.current = np.zeros((capacity, 2), dtype=np.float64)
+            self.radii = np.zeros(capacity, dtype=np.float32)
+            self.colors = np.zeros((capacity, 3), dtype=np.uint8)
+        self.count = count
+
+    def alpha(self):
+        """Interpolation factor between `previous` and `current`, in [0, 1]."""
+        since = (time.perf_counter() - self.published_at) * self.game_speed
+        return min(1.0, max(0.0, (self.accumulator + since) / self.dt))
+
+    def interpolated_positions(self, alpha=None):
+        count = self.count
+        previous = self.previous[:count]
+        return previous + (self.current[:count] - previous) * (self.alpha() if alpha is None else alpha)
+
+
+class SnapshotBuffer:
+    """Triple buffer handing Snapshots from the physics thread to the render thread without locks.
+
+    The writer fills a slot that is neither the latest one nor the one being read and then
+    publishes it; the reader always takes the latest published slot. Both sides only exchange
+    single attribute assignments, which are atomic, so neither ever waits for the other.
+    """
+
+    def __init__(self):
+        self.slots = [Snapshot(), Snapshot(), Snapshot()]
+        self.latest = None
+        self.reading = None
+
+    def begin_write(self):
+        latest, reading = self.latest, self.reading
+        for slot in self.slots:
+            if slot is not latest and slot is not reading:
+                return slot
+
+    def publish(self, slot):
+        slot.published_at = time.perf_counter()
+        self.latest = slot
+
+    def acquire(self):
+        """The latest published Snapshot (or None), safe to read until the next acquire."""
+        while True:
+            latest = self.latest
+            self.reading = latest
+            # The writer may have published (and started refilling the old slot) in between.
+            if self.latest is latest:
+                return latest
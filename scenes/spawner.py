@@ -0,0 +1,46 @@
+import numpy as np
+
+
+def lattice_positions(world_width, world_height, molecules_count, padding=100):
+    """Centres of a square lattice of about `molecules_count` points, `padding` away from the walls.
+
+    The actual number of points may be less than requested due to rounding down.
+    """
+    # Calculate the area of the simulation space
+    width = world_width - 2 * padding
+    height = world_height - 2 * padding
+
+    # The distance between neighbours, so that one dimension holds sqrt(count) molecules.
+    molecule_count_one_dim = int(molecules_count ** 0.5)
+    distance = min(width, height) / molecule_count_one_dim
+    columns = int(width // distance)
+    rows = int(height // distance)
+
+    i, j = np.meshgrid(np.arange(columns), np.arange(rows), indexing='ij')
+    positions = np.empty((columns * rows, 2), dtype=np.float64)
+    positions[:, 0] = padding + distance * i.ravel() + distance // 2
+    positions[:, 1] = padding + distance * j.ravel() + distance // 2
+    return positions
+
+
+def random_attributes(rng, count):
+    """Masses, radii and initial velocities (from a random impulse) for `count` molecules."""
+    masses = rng.integers(1, 11, count).astype(np.float64)
+    radii = rng.integers(2, 6, count).astype(np.float64)
+    impulses = rng.uniform(-100, 100, (count, 2))
+    return masses, radii, impulses / masses[:, None]
+
+
+def spawn_lattice(store, rng, world_width, world_height, molecules_count, timer=None, batch_size=10000):
+    """Fill a MoleculeStore with a randomized lattice, adding the bodies to the space in batches."""
+    positions = lattice_positions(world_width, world_height, molecules_count)
+    masses, radii, velocities = random_attributes(rng, len(positions))
+
+    for start in range(0, len(positions), batch_size):
+        batch = slice(start, start + batch_size)
+        if timer is None:
+            store.add_many(radii[batch], masses[batch], positions[batch], velocities[batch])
+        else:
+            with timer.phase('molecules.bodies'):
+                store.add_many(radii[batch], masses[batch], positions[batch], velocities[batch])
+    return len(positions)
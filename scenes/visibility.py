@@ -0,0 +1,192 @@
+import time
+
+import numpy as np
+import pymunk
+
+from particles.grid import Grid
+from scenes.constants import MOLECULES_LAYER
+
+
+class VisibilityIndex:
+    """Per-cell membership of the molecules around the viewport, kept up to date incrementally.
+
+    A cell is filled with one small `bb_query` the first time it is needed and then only
+    re-queried when it gets older than `max_age`, at most `refresh_budget` cells per query.
+    In between, the positions the renderer reads anyway are fed back through `update_moved`, and
+    only the molecules that crossed a cell boundary change membership. Queries for the same cells
+    within `min_interval` seconds return the previous result.
+
+    The zoomed-out heatmap does not use the membership, which is only kept up to date around the
+    viewport. It bins the positions of all molecules, `heatmap_budget` of which are read again
+    on every call, round-robin, so at 40k molecules each one is at most twenty calls old.
+    """
+
+    def __init__(self, space, world_width, world_height, cell_size=128, max_age=1.0, refresh_budget=8,
+                 min_interval=1 / 60, heatmap_budget=2000):
+        self.space = space
+        self.grid = Grid(world_width, world_height, cell_size)
+        self.max_age = max_age
+        self.refresh_budget = refresh_budget
+        self.min_interval = min_interval
+        self.heatmap_budget = heatmap_budget
+        self.query_filter = pymunk.ShapeFilter(mask=MOLECULES_LAYER)
+
+        self.members = {}  # Cell id -> set of molecule ids.
+        self.refreshed_at = {}  # Cell id -> time of the last bb_query.
+        self.cell_of_id = np.full(0, -1, dtype=np.intp)
+        self.arrays = {}  # Cell id -> cached array of its members.
+
+        self.last_cells = None
+        self.last_query = 0.0
+        self.last_result = np.zeros(0, dtype=np.intp)
+        self.heatmap_cells = np.full(0, -1, dtype=np.intp)  # Molecule id -> heatmap cell, -1 if never binned.
+        self.heatmap_next = 0  # Round-robin position, a molecule id.
+
+    def track(self, molecule_id):
+        if molecule_id >= len(self.cell_of_id):
+            grown = np.full(max(molecule_id + 1, 2 * len(self.cell_of_id)), -1, dtype=np.intp)
+            grown[:len(self.cell_of_id)] = self.cell_of_id
+            self.cell_of_id = grown
+
+    def move(self, molecule_id, cell):
+        old = self.cell_of_id[molecule_id]
+        if old == cell:
+            return
+        if old >= 0:
+            self.members[old].discard(molecule_id)
+            self.arrays.pop(old, None)
+        self.members.setdefault(cell, set()).add(molecule_id)
+        self.arrays.pop(cell, None)
+        self.cell_of_id[molecule_id] = cell
+
+    def refresh(self, cell, now):
+        row, column = divmod(cell, self.grid.columns)
+        size = self.grid.cell_size
+        bb = pymunk.BB(column * size, row * size, (column + 1) * size, (row + 1) * size)
+
+        found = set()
+        for shape in self.space.bb_query(bb, self.query_filter):
+            molecule_id = getattr(shape.body, 'molecule_id', None)
+            if molecule_id is None:
+                continue
+            # A shape may overlap the cell while its centre is in the neighbour.
+            x, y = shape.body.position
+            if int(x // size) != column or int(y // size) != row:
+                continue
+            found.add(molecule_id)
+            self.track(molecule_id)
+            self.move(molecule_id, cell)
+
+        # Whatever was listed here but not found has moved away unnoticed.
+        for molecule_id in self.members.get(cell, set()) - found:
+            self.cell_of_id[molecule_id] = -1
+        self.members[cell] = found
+        self.arrays.pop(cell, None)
+        self.refreshed_at[cell] = now
+
+    def query(self, left, top, right, bottom, now=None):
+        """Ids of the molecules in the cells overlapping the given world rectangle."""
+        now = time.perf_counter() if now is None else now
+        cells = self.grid.cells_in(left, top, right, bottom)
+        if (self.last_cells is not None and now - self.last_query < self.min_interval
+                and np.array_equal(cells, self.last_cells)):
+            return self.last_result
+
+        # Cells never seen are always filled, stale ones only within the budget, oldest first.
+        refreshed_at = self.refreshed_at
+        ages = [(refreshed_at[cell], cell) for cell in cells.tolist() if cell in refreshed_at]
+        for cell in cells.tolist():
+            if cell not in refreshed_at:
+                self.refresh(cell, now)
+        ages.sort()
+        for refreshed, cell in ages[:self.refresh_budget]:
+            if now - refreshed > self.max_age:
+                self.refresh(cell, now)
+
+        parts = []
+        for cell in cells.tolist():
+            array = self.arrays.get(cell)
+            if array is None:
+                array = self.arrays[cell] = np.fromiter(self.members.get(cell, ()), dtype=np.intp)
+            parts.append(array)
+
+        self.last_cells = cells
+        self.last_query = now
+        self.last_result = np.concatenate(parts) if parts else np.zeros(0, dtype=np.intp)
+        return self.last_result
+
+    def pin(self, left, top, right, bottom):
+        """Stop re-querying the cells inside a world rectangle whose molecules do not move."""
+        for cell in self.grid.cells_in(left, top, right - 1, bottom - 1).tolist():
+            if cell in self.refreshed_at:
+                self.refreshed_at[cell] = np.inf
+
+    def unpin(self, left, top, right, bottom):
+        """Re-query the cells inside a world rectangle on their next query."""
+        for cell in self.grid.cells_in(left, top, right - 1, bottom - 1).tolist():
+            if cell in self.refreshed_at:
+                self.refreshed_at[cell] = -np.inf
+
+    def update_moved(self, ids, positions):
+        """Feed back fresh positions, re-filing only the molecules that changed cell."""
+        if len(ids) == 0:
+            return
+        cells = self.grid.cell_of(positions)
+        moved = np.flatnonzero(cells != self.cell_of_id[ids])
+        for molecule_id, cell in zip(ids[moved].tolist(), cells[moved].tolist()):
+            self.move(molecule_id, cell)
+
+    def add(self, ids, positions):
+        """File new molecules under the cells of their positions."""
+        if len(ids) == 0:
+            return
+        self.track(int(ids.max()))
+        self.update_moved(ids, positions)
+        # The cached result of the last query does not have them.
+        self.last_cells = None
+
+    def heatmap(self, molecules):
+        """A (columns, rows, 3) image of the molecules per cell, tinted by their mean color.
+
+        The next `heatmap_budget` molecules are read from pymunk; molecules never binned before
+        start from the positions last stored in the MoleculeStore.
+        """
+        ids = molecules.indices()
+        if len(self.heatmap_cells) < molecules.size:
+            grown = np.full(max(molecules.size, 2 * len(self.heatmap_cells)), -1, dtype=np.intp)
+            grown[:len(self.heatmap_cells)] = self.heatmap_cells
+            self.heatmap_cells = grown
+        unseen = ids[self.heatmap_cells[ids] < 0]
+        self.heatmap_cells[unseen] = self.grid.cell_of(molecules.positions[unseen])
+
+        start = np.searchsorted(ids, self.heatmap_next)
+        batch = np.concatenate((ids[start:], ids[:start]))[:self.heatmap_budget]
+        if len(batch):
+            self.heatmap_cells[batch] = self.grid.cell_of(molecules.read_positions(batch))
+            self.heatmap_next = batch[-1] + 1
+        cells = self.heatmap_cells[ids]
+        size = len(self.grid)
+
+        counts = np.bincount(cells, minlength=size).astype(np.float64)
+        image = np.zeros((size, 3), dtype=np.float64)
+        colors = molecules.colors[ids]
+        for channel in range(3):
+            image[:, channel] = np.bincount(cells, weights=colors[:, channel], minlength=size)
+
+        occupied = counts > 0
+        if occupied.any():
+            image[occupied] /= counts[occupied, None]
+            # Brightness follows the number of molecules, relative to a busy cell.
+            reference = max(1.0, np.percentile(counts[occupied], 95))
+            image *= np.minimum(counts / reference, 1)[:, None]
+        return image.reshape(self.grid.rows, self.grid.columns, 3).transpose(1, 0, 2).astype(np.uint8)
+
+    def forget(self, molecule_id):
+        """Drop a removed molecule from the index."""
+        if molecule_id < len(self.heatmap_cells):
+            self.heatmap_cells[molecule_id] = -1
+        if molecule_id < len(self.cell_of_id) and self.cell_of_id[molecule_id] >= 0:
+            cell = self.cell_of_id[molecule_id]
+            self.members[cell].discard(molecule_id)
+            self.arrays.pop(cell, None)
+            self.cell_of_id[molecule_id] = -1
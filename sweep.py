@@ -0,0 +1,121 @@
+import argparse
+import functools
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+from particles.field import ForceField
+from scenes.headless import HeadlessRunner
+
+# pymunk runs at most two solver threads per space.
+MAX_SPACE_THREADS = 2
+# The cores of this worker process, set by pin_worker.
+worker_cores = None
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def pin_worker(core_sets):
+    """Pool initializer: take a set of cores of our own and stay on them."""
+    global worker_cores
+    worker_cores = core_sets.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, worker_cores)
+
+
+def run_sweep_case(case, steps, warmup, wave_interval):
+    parameters = dict(case)
+    molecules_count = parameters.pop('molecules')
+    seed = parameters.pop('seed')
+    result = {'case': case, 'cores': worker_cores}
+    try:
+        runner = HeadlessRunner(molecules_count=molecules_count, seed=seed, wave_interval=wave_interval,
+                                threads=min(len(worker_cores), MAX_SPACE_THREADS), **parameters)
+        runner.warm_up(warmup)
+        run = runner.run(steps)
+    except Exception as error:
+        # One broken case is reported and does not end the sweep.
+        result['error'] = f'{type(error).__name__}: {error}'
+        return result
+
+    result.update({name: run[name] for name in ('molecules', 'steps', 'elapsed', 'steps_per_sec', 'init_time',
+                                                'energy', 'waves')})
+    result['phases'] = {name: {'mean': phase['mean'], 'p95': phase.get('p95')} for name, phase in run['phases'].items()}
+    return result
+
+
+def sweep_cases(args):
+    """Every combination of the parameter lists, with every seed."""
+    grid = {
+        'molecules': args.molecules,
+        'damping': args.damping,
+        'wave_radius': args.wave_radius,
+        'wave_strength': args.wave_strength,
+        'max_impulse': args.max_impulse,
+        'field': args.field,
+        'seed': args.seeds,
+    }
+    return [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+
+def field_kind(text):
+    return None if text == 'none' else text
+
+
+def int_range(text):
+    low, high = text.split(':')
+    return int(low), int(high)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a grid of headless simulations in parallel.")
+    parser.add_argument('--molecules', type=int, nargs='+', default=[40000])
+    parser.add_argument('--damping', type=float, nargs='+', default=[0.95])
+    parser.add_argument('--wave-radius', type=int_range, nargs='+', default=[(500, 1000)], metavar='LOW:HIGH')
+    parser.add_argument('--wave-strength', type=int_range, nargs='+', default=[(50, 150)], metavar='LOW:HIGH')
+    parser.add_argument('--max-impulse', type=float, nargs='+', default=[1000])
+    parser.add_argument('--field', type=field_kind, nargs='+', default=[None], choices=(None,) + ForceField.KINDS,
+                        help="Long-range force fields to try, 'none' for none.")
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0])
+    parser.add_argument('--steps', type=int, default=1800)
+    parser.add_argument('--warmup', type=int, default=10,
+                        help="Steps before measuring, more if the spatial hash is still being tuned.")
+    parser.add_argument('--wave-interval', type=float, default=5.0, help="Seconds of simulated time between waves.")
+    parser.add_argument('--cores-per-run', type=int, default=1,
+                        help="Cores each run is pinned to, its space.threads is set to match.")
+    parser.add_argument('--out', default='sweep.jsonl', help="Results, one JSON object per run, in finishing order.")
+    args = parser.parse_args()
+
+    cases = sweep_cases(args)
+    cores = available_cores()
+    per_run = max(1, min(args.cores_per_run, len(cores)))
+    core_sets = [cores[start:start + per_run] for start in range(0, len(cores) - per_run + 1, per_run)]
+    workers = min(len(core_sets), len(cases))
+    print(f"{len(cases)} runs on {workers} workers with {per_run} core(s) each")
+
+    # Spawned workers start from a clean interpreter, like the benchmark cases.
+    context = multiprocessing.get_context('spawn')
+    os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+    queue = context.Queue()
+    for core_set in core_sets[:workers]:
+        queue.put(core_set)
+    start = time.perf_counter()
+    task = functools.partial(run_sweep_case, steps=args.steps, warmup=args.warmup, wave_interval=args.wave_interval)
+    with open(args.out, 'w') as out, context.Pool(workers, pin_worker, (queue,)) as pool:
+        jobs = pool.imap_unordered(task, cases)
+        for done, result in enumerate(jobs, 1):
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+            status = result.get('error') or f"{result['steps_per_sec']:.1f} steps/s"
+            print(f"[{done}/{len(cases)}] {result['case']} on cores {result['cores']}: {status}", flush=True)
+    print(f"done in {time.perf_counter() - start:.1f}s, results in {args.out}")
+
+
+if __name__ == "__main__":
+    main()